@@ -0,0 +1,141 @@
+import sys
+import os
+import json
+import struct
+import numpy as np
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+#Columnar output is a directory containing:
+#  manifest.json - number of rows, and the name, dtype and encoding of each column
+#  <column>.npy - one .npy array per column, loadable with np.load(mmap_mode='r')
+#  <column>.labels.npy - for string columns, the dictionary of distinct values; <column>.npy holds int32 codes into it, or NULL_CODE for NULLs
+
+MANIFEST_FILENAME = "manifest.json"
+#Value stored in integer columns for NULLs
+INT_NULL = -1
+#Code stored in string columns for NULLs; it isn't an index into the labels
+NULL_CODE = -1
+#Size of the .npy header we write; fixed so it can be rewritten with the final row count
+NPY_HEADER_SIZE = 128
+
+
+#Writes the .npy header for a 1-D array of length num_rows, padded to NPY_HEADER_SIZE bytes
+def write_npy_header(fp_out, dtype, num_rows):
+    header_dict = "{'descr': %s, 'fortran_order': False, 'shape': (%d,), }" % (repr(np.lib.format.dtype_to_descr(np.dtype(dtype))), num_rows)
+    prefix = np.lib.format.magic(1, 0)
+    header_len = NPY_HEADER_SIZE - len(prefix) - 2
+    header_str = header_dict.ljust(header_len-1) + "\n"
+    fp_out.write(prefix)
+    fp_out.write(struct.pack('<H', header_len))
+    fp_out.write(header_str.encode('latin1'))
+
+
+#One column of the output, appended to in batches
+class Column:
+
+    def __init__(self, directory, name, dtype):
+        self.name = name
+        self.filename = os.path.join(directory, "%s.npy" % name)
+        self.fp_out = open(self.filename, 'wb')
+        #Strings are dictionary-encoded
+        if dtype==str:
+            self.dtype = np.dtype(np.int32)
+            self.labels = dict()
+        else:
+            self.dtype = np.dtype(dtype)
+            self.labels = None
+        self.num_rows = 0
+        write_npy_header(self.fp_out, self.dtype, 0)
+
+    def append(self, values):
+        if self.labels is not None:
+            codes = []
+            for v in values:
+                if v is None:
+                    codes.append(NULL_CODE)
+                    continue
+                if v not in self.labels:
+                    self.labels[v] = len(self.labels)
+                codes.append(self.labels[v])
+            values = codes
+        elif self.dtype.kind=='f':
+            values = [np.nan if v is None else v for v in values]
+        else:
+            values = [INT_NULL if v is None else v for v in values]
+        data = np.asarray(values, dtype=self.dtype)
+        self.fp_out.write(data.tobytes())
+        self.num_rows += len(data)
+
+    def close(self):
+        #Now we know the length, fill it into the header
+        self.fp_out.seek(0)
+        write_npy_header(self.fp_out, self.dtype, self.num_rows)
+        self.fp_out.close()
+        if self.labels is not None:
+            labels = [str(l) for l in self.labels]
+            if len(labels)==0:
+                labels_array = np.zeros(0, dtype='U1')
+            else:
+                labels_array = np.array(labels, dtype=str)
+            np.save(os.path.join(os.path.dirname(self.filename), "%s.labels.npy" % self.name), labels_array)
+
+    def get_dict_representation(self):
+        obj_dict = dict()
+        obj_dict['name'] = self.name
+        obj_dict['dtype'] = np.lib.format.dtype_to_descr(self.dtype)
+        if self.labels is not None:
+            obj_dict['encoding'] = 'dictionary'
+            obj_dict['null_code'] = NULL_CODE
+        else:
+            obj_dict['encoding'] = 'plain'
+        return obj_dict
+
+
+#Writes query results column-by-column into a directory of .npy files
+class ColumnarWriter:
+
+    #dtypes is a list of numpy dtypes, or str for dictionary-encoded string columns
+    def __init__(self, directory, columns, dtypes):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.columns = []
+        for (c, d) in zip(columns, dtypes):
+            self.columns.append(Column(directory, c, d))
+
+    #rows is a list of tuples, in column order
+    def write_rows(self, rows):
+        if len(rows)==0:
+            return
+        for (column, values) in zip(self.columns, zip(*rows)):
+            column.append(values)
+
+    def close(self):
+        for c in self.columns:
+            c.close()
+        manifest = dict()
+        manifest['num_rows'] = self.columns[0].num_rows if len(self.columns)>0 else 0
+        manifest['columns'] = [c.get_dict_representation() for c in self.columns]
+        with open(os.path.join(self.directory, MANIFEST_FILENAME), 'w') as fp_out:
+            json.dump(manifest, fp_out, indent=4)
+            fp_out.flush()
+            fp_out.close()
+
+
+#Returns the manifest describing a columnar output directory
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'r') as fp_in:
+        manifest = json.load(fp_in)
+        fp_in.close()
+    return manifest
+
+#Returns a column as a memory-mapped array.  For string columns this is the codes; use load_labels() to decode them.
+def load_column(directory, name, mmap_mode='r'):
+    return np.load(os.path.join(directory, "%s.npy" % name), mmap_mode=mmap_mode)
+
+#Returns the dictionary of values for a string column, so that labels[codes] gives the strings.  Mask out codes equal to NULL_CODE first.
+def load_labels(directory, name):
+    return np.load(os.path.join(directory, "%s.labels.npy" % name))
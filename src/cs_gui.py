@@ -6,6 +6,9 @@ import models
 import data_products
 import filters
 import query_constructor
+import dimension_lookup
+import table_stats
+import run_query_builder as query_builder
 import run_database_wrapper as db_wrap
 import run_data_collector as data_collector
 import utilities
@@ -103,7 +106,7 @@ output_frame = ttk.LabelFrame(frame, text="Output Settings", padding=10)
 output_frame.grid(row=1, column=0, columnspan=3, sticky="ew", pady=5)
 
 tk.Label(output_frame, text="Output Format:").grid(row=0, column=0, sticky="e", padx=5, pady=2)
-tk.OptionMenu(output_frame, output_format, "csv", "sqlite").grid(row=0, column=1, sticky="w", padx=5, pady=2)
+tk.OptionMenu(output_frame, output_format, "csv", "csv.gz", "csv.zst", "sqlite", "columnar").grid(row=0, column=1, sticky="w", padx=5, pady=2)
 
 tk.Label(output_frame, text="Output Directory:").grid(row=1, column=0, sticky="e", padx=5, pady=2)
 tk.Entry(output_frame, textvariable=output_dir, width=30).grid(row=1, column=1, padx=5, pady=2)
@@ -201,43 +204,40 @@ def run_all():
                 except ValueError:
                     continue
 
-    query = query_constructor.construct_queries(model_obj, dp_obj, query_filters, event_list)
-    input_dict = {
-        "select": query.get_select_string(),
-        "from": query.get_from_string(),
-        "where": query.get_where_string(),
-        "data_product": dp_obj.get_name()
-    }
-    if query.get_sort():
-        input_dict["sort"] = query.get_sort()
-
-    input_file = os.path.join(output_dir.get(), f"csdata.{request_label.get()}.query")
-    with open(input_file, 'w') as f:
-        for k, v in input_dict.items():
-            f.write(f"{k} = {v}\n")
-
     config_file = os.path.join(os.getcwd(), "moment.cfg")
     config_dict = utilities.read_config(config_file)
+    lookup = dimension_lookup.DimensionLookup(config_dict)
+    stats = table_stats.TableStats(config_dict)
+    query = query_constructor.construct_queries(model_obj, dp_obj, query_filters, event_list, dimension_lookup=lookup, table_stats=stats)
+    input_file = os.path.join(output_dir.get(), f"csdata.{request_label.get()}.query")
+    #Write the query file the same way the query builder does (including any event table), then read it back
+    query_builder.write_queries(query, "", input_file, dp_obj.get_name())
+    input_dict = db_wrap.read_input(input_file)
+
     args_dict = {
         "input_filename": input_file,
         "output_filename": os.path.join(output_dir.get(), f"csdata.{request_label.get()}.data"),
         "config_filename": config_file,
         "output_format": output_format.get(),
     }
-    result_set = db_wrap.execute_queries(config_dict, input_dict)
+    #Stream the rows straight into the output file; write_results() also writes the URL file for seismograms
+    result_set = db_wrap.execute_cached_queries(config_dict, input_dict, stream=True)
     db_wrap.write_results(result_set, args_dict, input_dict, config_dict)
 
     if dp_obj.get_name() == "Seismograms":
-        db_wrap.write_url_file(args_dict, input_dict, config_dict, result_set)
         url_file = args_dict["output_filename"].replace(".data", ".urls")
         if os.path.exists(url_file):
             collector_args = {
                 "input_filename": url_file,
                 "output_directory": output_dir.get(),
-                "temp_directory": os.path.join(os.getcwd(), "temp")
+                "temp_directory": os.path.join(os.getcwd(), "temp"),
+                "temp_budget_mb": db_wrap.MAX_TEMP_DATA_MB
             }
-            data_collector.retrieve_files(collector_args)
-            data_collector.extract_rvs(collector_args)
+            #Download, extract and delete in batches, so temp usage stays under the budget
+            cache = data_collector.get_seismogram_cache(collector_args)
+            data_collector.run_windows(collector_args, cache)
+            if cache is not None:
+                cache.finish()
 
     messagebox.showinfo("Success", "CyberShake data retrieval complete.")
 
@@ -0,0 +1,54 @@
+import sys
+import os
+import pymysql
+import sqlite3
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+
+#Opens a connection to the database described in the config file.  Raises the driver's exception, or ValueError for an unknown type, if it can't.
+def connect(config_dict):
+    if config_dict['type'].lower()=='mysql':
+        return pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
+    elif config_dict['type'].lower()=='sqlite':
+        conn = sqlite3.connect(config_dict['db_path'])
+        #Return rows as dicts, to match the pymysql DictCursor
+        conn.row_factory = dict_factory
+        return conn
+    raise ValueError("Database type %s not recognized" % config_dict['type'])
+
+#Opens a connection to the database described in the config file, aborting if it can't
+def get_connection(config_dict):
+    if config_dict['type'].lower() not in ['mysql', 'sqlite']:
+        print("Database type %s not recognized, aborting." % config_dict['type'], file=sys.stderr)
+        sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+    try:
+        conn = connect(config_dict)
+    except Exception as e:
+        error_str = "Error connecting to %s database" % config_dict['type']
+        if config_dict['type'].lower()=='mysql':
+            error_str = "%s %s on host %s with username %s and password %s, aborting." % (error_str, config_dict['db'], config_dict['host'], config_dict['user'], config_dict['password'])
+        elif config_dict['type'].lower()=='sqlite':
+            error_str = "%s %s, aborting." % (error_str, config_dict['db_path'])
+        print(error_str, file=sys.stderr)
+        print(e)
+        sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+    return conn
+
+#Returns a cursor which gives rows as dicts
+def get_cursor(conn, config_dict, stream=False):
+    if config_dict['type'].lower()=='mysql':
+        #Use DictCursor in case we're retrieving seismograms
+        #The SSDictCursor leaves the results on the server until we fetch them
+        if stream==True:
+            return conn.cursor(cursor=pymysql.cursors.SSDictCursor)
+        return conn.cursor(cursor=pymysql.cursors.DictCursor)
+    #SQLite cursors step through the results as they are fetched, and use dict_factory
+    return conn.cursor()
+
+def dict_factory(cursor, row):
+    return dict(zip([d[0] for d in cursor.description], row))
@@ -0,0 +1,179 @@
+import sys
+import os
+import json
+import time
+import tempfile
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+import query_cache
+import db_connection
+
+#Component used for period-based IMs
+IM_COMPONENT = "RotD50"
+#IMs which are selected by measure instead of by period
+IM_MEASURES = ["PGA", "PGV"]
+#Number of decimal places to compare periods at
+PERIOD_DECIMALS = 6
+#A name which isn't found only makes the lookup re-read the tables if the saved copy is older than this, in seconds
+AUTO_REFRESH_MIN_AGE = 3600
+
+#Columns which can be bound straight to a study's ERF_ID and Rup_Var_Scenario_ID, as (table, column, study key)
+study_key_columns = [("Ruptures", "ERF_ID", "ERF_ID"),
+                     ("Rupture_Variations", "ERF_ID", "ERF_ID"),
+                     ("Rupture_Variations", "Rup_Var_Scenario_ID", "Rup_Var_Scenario_ID"),
+                     ("CyberShake_Site_Ruptures", "ERF_ID", "ERF_ID")]
+
+def get_default_cache_dir():
+    return os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'dimensions'))
+
+def get_period_key(period):
+    return "%.*f" % (PERIOD_DECIMALS, float(period))
+
+
+#Resolves study, site and IM names to the integer IDs the big tables are keyed on, so queries can use the IDs directly
+#instead of joining the dimension tables to match on names.
+#The dimension tables are small, so they're read in full and saved locally, one file per database.
+#If a name isn't found and the saved copy is over AUTO_REFRESH_MIN_AGE old, the tables are re-read once in case they've changed.
+#If the database can't be read, names which can't be resolved are left to the query to match, as before.
+class DimensionLookup:
+
+    def __init__(self, config_dict, cache_dir=None):
+        self.config_dict = config_dict
+        if cache_dir is None:
+            cache_dir = get_default_cache_dir()
+        self.cache_dir = cache_dir
+        self.cache_path = os.path.join(self.cache_dir, "%s.json" % query_cache.get_database_key(config_dict))
+        self.dimensions = None
+        self.refreshed = False
+        #Counts refreshes, so queries built from earlier contents can be told apart
+        self.generation = 0
+
+    #Reads the dimension tables from the database, and saves them.
+    #If the database can't be read, warns and keeps what it has, which is nothing if there's no saved copy.
+    def refresh(self):
+        self.refreshed = True
+        self.generation += 1
+        dimensions = dict()
+        try:
+            conn = db_connection.connect(self.config_dict)
+        except Exception as e:
+            print("Warning: couldn't connect to the database to read study, site and IM IDs, so names will be matched in the query: %s" % str(e), file=sys.stderr)
+            self.set_fallback_dimensions()
+            return
+        cur = db_connection.get_cursor(conn, self.config_dict)
+        try:
+            #ERF and rupture variation scenario come from the study's runs
+            cur.execute('select distinct Studies.Study_ID, Studies.Study_Name, CyberShake_Runs.ERF_ID, CyberShake_Runs.Rup_Var_Scenario_ID from Studies, CyberShake_Runs where CyberShake_Runs.Study_ID=Studies.Study_ID')
+            dimensions['studies'] = [dict(row) for row in cur.fetchall()]
+            cur.execute('select CS_Site_ID, CS_Short_Name from CyberShake_Sites')
+            dimensions['sites'] = [dict(row) for row in cur.fetchall()]
+            cur.execute('select IM_Type_ID, IM_Type_Measure, IM_Type_Value, IM_Type_Component from IM_Types')
+            dimensions['im_types'] = [dict(row) for row in cur.fetchall()]
+        except Exception as e:
+            print("Warning: couldn't read study, site and IM IDs from the database, so names will be matched in the query: %s" % str(e), file=sys.stderr)
+            cur.close()
+            conn.close()
+            self.set_fallback_dimensions()
+            return
+        cur.close()
+        conn.close()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            (fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, 'w') as fp_out:
+                json.dump(dimensions, fp_out, default=float)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print("Warning: couldn't save IDs to %s: %s" % (self.cache_path, str(e)))
+        self.set_dimensions(dimensions)
+
+    #Without the tables, nothing resolves, so the query constructor uses the name predicates
+    def set_fallback_dimensions(self):
+        if self.dimensions is None:
+            self.set_dimensions({'studies': [], 'sites': [], 'im_types': []})
+
+    #Re-reads the tables for a name which wasn't found, unless that's already been done or the saved copy is recent
+    def refresh_for_missing(self):
+        if self.refreshed:
+            return
+        try:
+            if time.time()-os.path.getmtime(self.cache_path)<AUTO_REFRESH_MIN_AGE:
+                return
+        except OSError:
+            pass
+        self.refresh()
+
+    #Builds the lookup dicts from the dimension table rows
+    def set_dimensions(self, dimensions):
+        self.dimensions = dict()
+        studies = dict()
+        for row in dimensions['studies']:
+            studies.setdefault(row['Study_Name'], []).append(row)
+        self.dimensions['study'] = dict()
+        for (name, rows) in studies.items():
+            study = dict()
+            study['Study_ID'] = rows[0]['Study_ID']
+            #Only bind the ERF and scenario if all the study's runs agree
+            for key in ['ERF_ID', 'Rup_Var_Scenario_ID']:
+                if len(set([row[key] for row in rows]))==1:
+                    study[key] = rows[0][key]
+            self.dimensions['study'][name] = study
+        self.dimensions['site'] = dict()
+        for row in dimensions['sites']:
+            self.dimensions['site'][row['CS_Short_Name']] = [row['CS_Site_ID']]
+        self.dimensions['im_type'] = dict()
+        for row in dimensions['im_types']:
+            if row['IM_Type_Measure'] in IM_MEASURES:
+                self.dimensions['im_type'].setdefault(row['IM_Type_Measure'], []).append(row['IM_Type_ID'])
+            elif row['IM_Type_Component']==IM_COMPONENT and row['IM_Type_Value'] is not None:
+                self.dimensions['im_type'].setdefault(get_period_key(row['IM_Type_Value']), []).append(row['IM_Type_ID'])
+
+    def load(self):
+        if self.dimensions is not None:
+            return
+        try:
+            with open(self.cache_path, 'r') as fp_in:
+                self.set_dimensions(json.load(fp_in))
+        except (OSError, ValueError, KeyError):
+            self.refresh()
+
+    #Returns the dict of IDs for a study, or None if it isn't in the database
+    def get_study(self, study_name):
+        self.load()
+        if study_name not in self.dimensions['study']:
+            self.refresh_for_missing()
+        return self.dimensions['study'].get(study_name)
+
+    #dimension is 'site' or 'im_type'.  Returns the list of IDs matching the values, or None if any value can't be resolved.
+    def get_ids(self, dimension, values):
+        self.load()
+        keys = [self.get_key(dimension, v) for v in values]
+        if any([k not in self.dimensions[dimension] for k in keys]):
+            self.refresh_for_missing()
+        ids = []
+        for k in keys:
+            if k not in self.dimensions[dimension]:
+                return None
+            ids.extend(self.dimensions[dimension][k])
+        return sorted(set(ids))
+
+    def get_key(self, dimension, value):
+        if dimension=='im_type' and value not in IM_MEASURES:
+            return get_period_key(value)
+        return value
+
+    #Returns (SQL, params) predicates binding the tables in from_tables to the study's ERF and scenario
+    def get_study_key_clauses(self, study_name, from_tables):
+        study = self.get_study(study_name)
+        where_clauses = []
+        if study is None:
+            return where_clauses
+        for (table, column, key) in study_key_columns:
+            if table in from_tables and key in study:
+                where_clauses.append(("%s.%s=%%s" % (table, column), [study[key]]))
+        return where_clauses
@@ -66,6 +66,8 @@ class Filter:
 		self.units = units
 		#Other filters which must also be added if this filter is added
 		self.requires_filters = []
+		#Query on integer IDs, used if the values can be resolved to IDs
+		self.id_query = None
 
 	def get_name(self):
 		return self.name
@@ -94,6 +96,15 @@ class Filter:
 	def get_query(self):
 		return (self.where_fields, self.from_tables)
 
+	#The key column to select on instead, once the values are resolved to IDs
+	#dimension is the kind of ID, as understood by dimension_lookup.DimensionLookup.get_ids()
+	def set_id_query(self, fields=[], tables=[], dimension=None):
+		self.id_query = (fields, tables, dimension)
+
+	#Returns (where fields, from tables, dimension), or None if this filter can't use IDs
+	def get_id_query(self):
+		return self.id_query
+
 	def get_contains(self):
 		return self.contains
 
@@ -249,6 +260,7 @@ def create_filters():
 	im_type_filter = EnumeratedFilter('Intensity Measure Period', filt_type=float, data_product=FilterDataProducts.IMS, help_string="Type of intensity measure.")
 	#im_type_filter.set_values_list([2.0, 3.0, 4.0, 5.0, 7.5, 10.0, "PGV"])
 	im_type_filter.set_query(fields=["IM_Types.IM_Type_Value"], tables=["IM_Types"])
+	im_type_filter.set_id_query(fields=["PeakAmplitudes.IM_Type_ID"], tables=["PeakAmplitudes"], dimension="im_type")
 	filters.append(im_type_filter)
 	#IM value
 	im_value_filter = RangeFilter('Intensity Measure Value', filt_type=float, data_product=FilterDataProducts.IMS, help_string="Value of intensity measure, in cm/s2.", units='cm/sec2')
@@ -265,6 +277,7 @@ def create_filters():
 	sites_filter = Filter('Site Name', filt_type=str, data_product=FilterDataProducts.SITES, help_string="3-5 character site name.")
 	#sites_filter.set_values_list(["USC", "PAS", "WNGC", "STNI"])
 	sites_filter.set_query(fields=["CyberShake_Sites.CS_Short_Name"], tables=['CyberShake_Sites'])
+	sites_filter.set_id_query(fields=["CyberShake_Runs.Site_ID"], tables=['CyberShake_Runs'], dimension="site")
 	filters.append(sites_filter)
 	#Site-Rupture dist
 	site_rup_dist_filter = RangeFilter('Site-Rupture Distance', filt_type=float, data_product=FilterDataProducts.EVENTS, help_string="Site-rupture distance, which is determined by calculating the distance between the site and each point on the rupture surface and taking the minimum.", units="km")
@@ -0,0 +1,218 @@
+import sys
+import os
+import heapq
+import functools
+import re
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+
+#Schema join graph: the equality predicates which join each pair of related tables
+join_edges = [
+    ("CyberShake_Runs", "CyberShake_Sites", ["CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID"]),
+    ("CyberShake_Runs", "CyberShake_Site_Ruptures", ["CyberShake_Runs.Site_ID=CyberShake_Site_Ruptures.CS_Site_ID", "CyberShake_Runs.ERF_ID=CyberShake_Site_Ruptures.ERF_ID"]),
+    ("CyberShake_Runs", "PeakAmplitudes", ["CyberShake_Runs.Run_ID=PeakAmplitudes.Run_ID"]),
+    ("CyberShake_Runs", "Rupture_Variations", ["CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID", "CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID"]),
+    ("CyberShake_Runs", "Ruptures", ["CyberShake_Runs.ERF_ID=Ruptures.ERF_ID"]),
+    ("CyberShake_Runs", "Studies", ["CyberShake_Runs.Study_ID=Studies.Study_ID"]),
+    ("CyberShake_Site_Ruptures", "CyberShake_Sites", ["CyberShake_Site_Ruptures.CS_Site_ID=CyberShake_Sites.CS_Site_ID"]),
+    ("CyberShake_Site_Ruptures", "Ruptures", ["CyberShake_Site_Ruptures.ERF_ID=Ruptures.ERF_ID", "CyberShake_Site_Ruptures.Source_ID=Ruptures.Source_ID", "CyberShake_Site_Ruptures.Rupture_ID=Ruptures.Rupture_ID"]),
+    ("IM_Types", "PeakAmplitudes", ["IM_Types.IM_Type_ID=PeakAmplitudes.IM_Type_ID"]),
+    ("PeakAmplitudes", "Ruptures", ["Ruptures.Source_ID=PeakAmplitudes.Source_ID", "Ruptures.Rupture_ID=PeakAmplitudes.Rupture_ID"]),
+    ("PeakAmplitudes", "Rupture_Variations", ["Rupture_Variations.Source_ID=PeakAmplitudes.Source_ID", "Rupture_Variations.Rupture_ID=PeakAmplitudes.Rupture_ID", "Rupture_Variations.Rup_Var_ID=PeakAmplitudes.Rup_Var_ID"]),
+    ("Rupture_Variations", "Ruptures", ["Rupture_Variations.ERF_ID=Ruptures.ERF_ID", "Rupture_Variations.Source_ID=Ruptures.Source_ID", "Rupture_Variations.Rupture_ID=Ruptures.Rupture_ID"]),
+    (utilities.EVENT_TABLE_NAME, "Rupture_Variations", ["Rupture_Variations.Source_ID=%s.Source_ID" % utilities.EVENT_TABLE_NAME, "Rupture_Variations.Rupture_ID=%s.Rupture_ID" % utilities.EVENT_TABLE_NAME, "Rupture_Variations.Rup_Var_ID=%s.Rup_Var_ID" % utilities.EVENT_TABLE_NAME]),
+]
+
+#Relative cost of pulling a table into a query just to connect two others; roughly follows table size
+table_costs = dict()
+table_costs["Studies"] = 1
+table_costs["CyberShake_Sites"] = 1
+table_costs["IM_Types"] = 1
+table_costs["CyberShake_Runs"] = 2
+table_costs["Ruptures"] = 3
+table_costs["CyberShake_Site_Ruptures"] = 5
+table_costs["Rupture_Variations"] = 6
+table_costs["PeakAmplitudes"] = 10
+#Only exists when the request has an event list, so never use it as a connector
+table_costs[utilities.EVENT_TABLE_NAME] = 1000
+
+
+class JoinPlanningError(Exception):
+    pass
+
+
+#Adjacency: table -> {neighbor table: predicates}
+join_graph = dict()
+for (table1, table2, predicates) in join_edges:
+    join_graph.setdefault(table1, dict())[table2] = predicates
+    join_graph.setdefault(table2, dict())[table1] = predicates
+
+
+#Returns the cheapest path from any table in tree to any table in targets, as a list of tables.
+#Tables already in the query cost nothing to pass through.
+def find_cheapest_path(tree, targets, required):
+    distances = dict()
+    previous = dict()
+    heap = []
+    for t in tree:
+        distances[t] = 0
+        heapq.heappush(heap, (0, t))
+    while len(heap)>0:
+        (dist, table) = heapq.heappop(heap)
+        if dist>distances[table]:
+            continue
+        if table in targets:
+            path = [table]
+            while path[-1] in previous:
+                path.append(previous[path[-1]])
+            return path
+        for neighbor in sorted(join_graph[table]):
+            cost = 0 if neighbor in required else table_costs.get(neighbor, 1)
+            if neighbor not in distances or dist+cost<distances[neighbor]:
+                distances[neighbor] = dist+cost
+                previous[neighbor] = table
+                heapq.heappush(heap, (dist+cost, neighbor))
+    return None
+
+#Finds the column equivalence class for a column, for the union-find in plan_joins()
+def find_root(parents, column):
+    while parents.setdefault(column, column)!=column:
+        parents[column] = parents[parents[column]]
+        column = parents[column]
+    return column
+
+#Works out how to join a set of tables.  Returns (tables which must be added to connect them, join predicates).
+#Connects the tables with an approximate minimum Steiner tree over the join graph, then keeps only enough
+#predicates from the edges between the chosen tables to make the same columns equal.
+#Plans are cached, since the same table sets come up over and over.
+@functools.lru_cache(maxsize=None)
+def plan_joins(tables):
+    for t in tables:
+        if t not in join_graph:
+            raise JoinPlanningError("Don't know how to join table %s to any other table." % t)
+    required = sorted(tables)
+    if len(required)<2:
+        return ((), ())
+    tree = set([required[0]])
+    tree_edges = []
+    remaining = set(required[1:])
+    while len(remaining)>0:
+        path = find_cheapest_path(tree, remaining, tables)
+        if path is None:
+            raise JoinPlanningError("Can't join tables %s to tables %s." % (", ".join(sorted(remaining)), ", ".join(sorted(tree))))
+        for i in range(0, len(path)-1):
+            tree_edges.append((path[i], path[i+1]))
+        tree.update(path)
+        remaining.difference_update(tree)
+    #Use the tree edges first, then the other edges between chosen tables, which may bind more key columns
+    edges = []
+    for (table1, table2) in tree_edges:
+        edges.append(join_graph[table1][table2])
+    for (table1, table2, predicates) in join_edges:
+        if table1 in tree and table2 in tree and predicates not in edges:
+            edges.append(predicates)
+    parents = dict()
+    join_predicates = []
+    for predicates in edges:
+        for p in predicates:
+            (left, right) = p.split("=")
+            (left_root, right_root) = (find_root(parents, left), find_root(parents, right))
+            if left_root!=right_root:
+                parents[left_root] = right_root
+                join_predicates.append(p)
+    added_tables = tuple(sorted(tree.difference(tables)))
+    return (added_tables, tuple(join_predicates))
+
+#Selectivity guesses for predicates we have no statistics for
+DEFAULT_EQUALITY_SELECTIVITY = 0.1
+DEFAULT_RANGE_SELECTIVITY = 0.3
+LIKE_SELECTIVITY = 0.1
+#Rows assumed per unit of table cost, for tables without a row count
+DEFAULT_ROWS_PER_COST = 100000
+
+#Returns the list of 'Table.Column' references in a predicate
+def get_column_references(sql):
+    return re.findall(r"\b([A-Za-z_]+\.[A-Za-z_0-9]+)\b", sql)
+
+#Estimates the fraction of the table's rows which pass a single-table predicate
+def estimate_selectivity(sql, params, column, table_rows, stats):
+    distinct = stats.get_distinct_count(column)
+    lower_sql = sql.lower()
+    if " like " in lower_sql:
+        return LIKE_SELECTIVITY
+    if " or " in lower_sql:
+        #Event lists: roughly one row per few parameters
+        return min(1.0, len(params)/float(max(table_rows, 1)))
+    if " in (" in lower_sql:
+        if distinct is not None:
+            return min(1.0, len(params)/float(max(distinct, 1)))
+        return min(1.0, len(params)*DEFAULT_EQUALITY_SELECTIVITY)
+    if ">=" in sql or "<=" in sql or " between " in lower_sql:
+        value_range = stats.get_range(column)
+        if value_range is None or len(params)!=2 or value_range[1]<=value_range[0]:
+            return DEFAULT_RANGE_SELECTIVITY
+        (low, high) = (max(float(params[0]), value_range[0]), min(float(params[1]), value_range[1]))
+        return max(0.0, high-low)/(value_range[1]-value_range[0])
+    if "=" in sql:
+        if distinct is not None:
+            return 1.0/max(distinct, 1)
+        return DEFAULT_EQUALITY_SELECTIVITY
+    return 1.0
+
+#Estimates how many rows of each table pass the query's filters.  row_counts overrides the statistics for any tables, such as the event table.
+#Also returns table -> most selective filtered column.
+def estimate_filtered_rows(tables, where_clauses, stats, row_counts=None):
+    estimates = dict()
+    for t in tables:
+        if row_counts is not None and t in row_counts:
+            estimates[t] = float(row_counts[t])
+        elif stats.get_row_count(t) is not None:
+            estimates[t] = float(stats.get_row_count(t))
+        else:
+            estimates[t] = float(table_costs.get(t, 1)*DEFAULT_ROWS_PER_COST)
+    best_columns = dict()
+    best_selectivity = dict()
+    for (sql, params) in where_clauses:
+        columns = set(get_column_references(sql))
+        tables_referenced = set([c.split(".")[0] for c in columns])
+        #Skip joins, and predicates we can't attribute to a table
+        if len(tables_referenced)!=1:
+            continue
+        table = tables_referenced.pop()
+        if table not in estimates:
+            continue
+        column = sorted(columns)[0]
+        selectivity = estimate_selectivity(sql, params, column, estimates[table], stats)
+        estimates[table] *= selectivity
+        if len(columns)==1 and selectivity<best_selectivity.get(table, 1.0):
+            best_selectivity[table] = selectivity
+            best_columns[table] = column
+    return (estimates, best_columns)
+
+#Picks a join order for the tables: starts from the table with the fewest rows left after filtering,
+#then repeatedly adds the smallest table which joins to one already chosen.
+#Returns (ordered list of tables, table -> index to use).  Only the driving table gets an index, from the statistics, leading with its filtered column;
+#the tables joined after it are looked up by their join columns, so MySQL has to be free to use their primary keys or join indexes.
+def order_joins(tables, where_clauses, stats, row_counts=None):
+    (estimates, best_columns) = estimate_filtered_rows(tables, where_clauses, stats, row_counts)
+    remaining = set(tables)
+    order = []
+    while len(remaining)>0:
+        candidates = [t for t in remaining if len(order)==0 or any([o in join_graph.get(t, dict()) for o in order])]
+        if len(candidates)==0:
+            #Not connected; shouldn't happen once plan_joins() has run
+            candidates = list(remaining)
+        next_table = min(candidates, key=lambda t: (estimates[t], t))
+        order.append(next_table)
+        remaining.remove(next_table)
+    index_hints = dict()
+    if len(order)>0 and order[0] in best_columns:
+        index = stats.get_index(order[0], best_columns[order[0]].split(".")[1])
+        if index is not None:
+            index_hints[order[0]] = index
+    return (order, index_hints)
@@ -25,7 +25,16 @@ def parse_args(argv):
     parser.add_argument('-t', '--temp-directory', dest='temp_directory', action='store', default=".", help="Path to temporary directory to store files before extraction (optional, default is current working directory).")
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to JSON file describing desired data products and filters to apply, in format outputted by Filter Generator step.  If supplied, Filter Generator is bypassed.  (optional)")
     parser.add_argument('-e', '--input-event-filename', dest='input_event_filename', action='store', default=None, help="(Optional) path to CSV file containing src id, rup id, rup var id values.  This will bypass the event filters.")
-    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results (either "csv" or "sqlite")')
+    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results ("csv", "csv.gz", "csv.zst", "sqlite", or "columnar")')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true', default=False, help='Stream database results to the output file in batches instead of loading them all into memory (optional).')
+    parser.add_argument('-p', '--partition-by', dest='partition_key', action='store', default=None, choices=['site', 'im_type', 'source'], help='Split the database query by site, IM type, or source ID ranges and run the pieces in parallel (optional).')
+    parser.add_argument('-j', '--parallel', dest='num_partitions', action='store', type=int, default=None, help='Number of partitions to run in parallel with --partition-by (optional).')
+    parser.add_argument('--estimate', dest='estimate', action='store_true', default=False, help='Estimate the size of the request and exit, without retrieving any data (optional).')
+    parser.add_argument('--force', dest='force', action='store_true', default=False, help='Run the request even if it is estimated to be very large (optional).')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True, help='Always query the database, without using the local query results cache (optional).')
+    parser.add_argument('--refresh', dest='refresh_cache', action='store_true', default=False, help='Re-run the query and replace any cached results (optional).')
+    parser.add_argument('--use-hints', dest='use_hints', action='store_true', default=False, help='On MySQL, force the planned join order and index instead of letting MySQL plan the query (optional).')
+    parser.add_argument('--compare-plans', dest='compare_plans', action='store_true', default=False, help='Time the request with the planned join order and with MySQL\'s own plan, and exit (optional).')
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args_dict = dict()
@@ -57,6 +66,15 @@ def parse_args(argv):
     args_dict['input_filename'] = args.input_filename
     args_dict['debug'] = args.debug
     args_dict['output_format'] = args.output_format
+    args_dict['stream'] = args.stream
+    args_dict['partition_key'] = args.partition_key
+    args_dict['num_partitions'] = args.num_partitions
+    args_dict['estimate'] = args.estimate
+    args_dict['force'] = args.force
+    args_dict['use_cache'] = args.use_cache
+    args_dict['refresh_cache'] = args.refresh_cache
+    args_dict['use_hints'] = args.use_hints
+    args_dict['compare_plans'] = args.compare_plans
     args_dict['input_event_filename'] = args.input_event_filename
     return args_dict
 
@@ -84,6 +102,8 @@ def run_query_builder(args_dict):
         arg_string = '-i %s/csdata.%s.json' % (args_dict['output_directory'], args_dict['request_label'])
     if args_dict['debug']==True:
         arg_string = "%s -d" % arg_string
+    #Resolve names to IDs against the same database the wrapper will query
+    arg_string = "%s -c %s" % (arg_string, args_dict['config_filename'])
     args_dict['output_directory'] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'output'))
     os.makedirs(args_dict['output_directory'], exist_ok=True)
     arg_string = "%s -o %s/csdata.%s.query" % (arg_string, args_dict['output_directory'], args_dict['request_label'])
@@ -93,12 +113,30 @@ def run_database_wrapper(args_dict):
     args_dict['output_directory'] = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'output'))
     os.makedirs(args_dict['output_directory'], exist_ok=True)
     arg_string = "-of %s -i %s/csdata.%s.query -o %s/csdata.%s.data -c %s" % (args_dict['output_format'], args_dict['output_directory'], args_dict['request_label'], args_dict['output_directory'], args_dict['request_label'], args_dict['config_filename'])
+    if args_dict.get('stream', False)==True:
+        arg_string = "%s -s" % arg_string
+    if args_dict.get('partition_key') is not None:
+        arg_string = "%s -p %s" % (arg_string, args_dict['partition_key'])
+    if args_dict.get('num_partitions') is not None:
+        arg_string = "%s -j %d" % (arg_string, args_dict['num_partitions'])
+    if args_dict.get('estimate', False)==True:
+        arg_string = "%s --estimate" % arg_string
+    if args_dict.get('force', False)==True:
+        arg_string = "%s --force" % arg_string
+    if args_dict.get('use_cache', True)==False:
+        arg_string = "%s --no-cache" % arg_string
+    if args_dict.get('refresh_cache', False)==True:
+        arg_string = "%s --refresh" % arg_string
+    if args_dict.get('use_hints', False)==True:
+        arg_string = "%s --use-hints" % arg_string
+    if args_dict.get('compare_plans', False)==True:
+        arg_string = "%s --compare-plans" % arg_string
     if args_dict['debug']==True:
         arg_string = "%s -d" % arg_string
     db_wrap.run_main(arg_string.split())
 
 def run_data_collector(args_dict, url_file):
-    arg_string = "-i %s -o %s -t %s" % (url_file, args_dict['output_directory'], args_dict['temp_directory'])
+    arg_string = "-i %s -o %s -t %s -b %d" % (url_file, args_dict['output_directory'], args_dict['temp_directory'], db_wrap.MAX_TEMP_DATA_MB)
     if args_dict['debug']==True:
         arg_string = "%s -d" % arg_string
     data_collector.run_main(arg_string.split())
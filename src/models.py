@@ -12,9 +12,14 @@ class Model:
     def get_name(self):
         return self.name
      
-    def get_query(self):
+    #If dimension_lookup is given and knows this study, select on the study ID instead of joining Studies for the name
+    def get_query(self, dimension_lookup=None):
+        if dimension_lookup is not None:
+            study = dimension_lookup.get_study(self.name)
+            if study is not None:
+                return (['CyberShake_Runs'], [('CyberShake_Runs.Study_ID=%s', [study['Study_ID']])])
         from_table = 'Studies'
-        where_clause = 'Studies.Study_Name="%s"' % self.name
+        where_clause = ('Studies.Study_Name=%s', [self.name])
         return ([from_table], [where_clause])
     
     def get_dict_representation(self):
@@ -0,0 +1,173 @@
+import sys
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+
+#Maximum total size of cached query results, in MB
+MAX_CACHE_SIZE_MB = 2000
+CACHE_SUFFIX = ".results"
+STATS_FILENAME = "stats.json"
+#Held while updating the stats
+STATS_LOCK_FILENAME = "stats.lock"
+#Number of rows per pickled batch in a cache entry
+CACHE_BATCH_SIZE = 10000
+#Results larger than this fraction of the cache aren't kept, since they'd evict most other entries, or themselves
+MAX_ENTRY_FRACTION = 0.25
+
+#Parts of the query file which determine the results
+query_keys = ['select', 'from', 'where', 'params', 'sort']
+
+def get_default_cache_dir():
+    return os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'queries'))
+
+#Collapses runs of whitespace, so trivially different query files map to the same entry
+def normalize_sql(sql):
+    return " ".join(sql.split())
+
+#Returns a dict identifying the database in the config file
+def get_database_identity(config_dict):
+    key_dict = dict()
+    key_dict['type'] = config_dict['type'].lower()
+    if key_dict['type']=='sqlite':
+        key_dict['db_path'] = os.path.abspath(config_dict['db_path'])
+    else:
+        key_dict['host'] = config_dict.get('host', '')
+        key_dict['db'] = config_dict.get('db', '')
+    return key_dict
+
+#Returns a hash identifying the database, for naming per-database files
+def get_database_key(config_dict):
+    return hashlib.sha256(json.dumps(get_database_identity(config_dict), sort_keys=True).encode('utf-8')).hexdigest()
+
+#Returns the hash identifying the results of this query against this database
+def get_cache_key(config_dict, input_dict):
+    key_dict = get_database_identity(config_dict)
+    for k in query_keys:
+        if k in input_dict:
+            key_dict[k] = normalize_sql(str(input_dict[k]))
+    #The event table is identified by its contents, not its path
+    if 'event_table' in input_dict:
+        with open(input_dict['event_table'], 'rb') as fp_in:
+            key_dict['event_table'] = hashlib.sha256(fp_in.read()).hexdigest()
+    key_string = json.dumps(key_dict, sort_keys=True)
+    return hashlib.sha256(key_string.encode('utf-8')).hexdigest()
+
+
+#On-disk cache of query results, with least-recently-used eviction once it's larger than max_size_mb.
+#Each entry is a file of pickled objects: the cursor description, then lists of row tuples.
+class QueryCache:
+
+    def __init__(self, cache_dir=None, max_size_mb=MAX_CACHE_SIZE_MB):
+        if cache_dir is None:
+            cache_dir = get_default_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, "%s%s" % (key, CACHE_SUFFIX))
+
+    def contains(self, config_dict, input_dict):
+        return os.path.exists(self.get_entry_path(get_cache_key(config_dict, input_dict)))
+
+    #Returns (description, row generator) for the cached results, or None if they aren't cached
+    def get(self, config_dict, input_dict):
+        path = self.get_entry_path(get_cache_key(config_dict, input_dict))
+        try:
+            fp_in = open(path, 'rb')
+        except OSError:
+            self.update_stats(hit=False)
+            return None
+        #Mark as recently used
+        os.utime(path)
+        self.update_stats(hit=True)
+        description = pickle.load(fp_in)
+        return (description, self.read_rows(fp_in, description))
+
+    def read_rows(self, fp_in, description):
+        columns = [d[0] for d in description]
+        with fp_in:
+            while True:
+                try:
+                    batch = pickle.load(fp_in)
+                except EOFError:
+                    break
+                for row in batch:
+                    yield dict(zip(columns, row))
+
+    #Passes the rows through, saving them as a cache entry once they've all been read.
+    #Once the entry is larger than MAX_ENTRY_FRACTION of the cache, it's dropped and the remaining rows are just passed through.
+    def store(self, config_dict, input_dict, description, rows):
+        path = self.get_entry_path(get_cache_key(config_dict, input_dict))
+        max_entry_bytes = self.max_size_mb*1000000*MAX_ENTRY_FRACTION
+        (fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        fp_out = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(description, fp_out, protocol=pickle.HIGHEST_PROTOCOL)
+            batch = []
+            for row in rows:
+                if fp_out is not None:
+                    batch.append(tuple(row.values()))
+                    if len(batch)==CACHE_BATCH_SIZE:
+                        pickle.dump(batch, fp_out, protocol=pickle.HIGHEST_PROTOCOL)
+                        batch = []
+                        if fp_out.tell()>max_entry_bytes:
+                            print("Query results are larger than %d MB, so they won't be cached." % (max_entry_bytes/1000000))
+                            fp_out.close()
+                            os.remove(temp_path)
+                            fp_out = None
+                yield row
+            if fp_out is not None:
+                if len(batch)>0:
+                    pickle.dump(batch, fp_out, protocol=pickle.HIGHEST_PROTOCOL)
+                fp_out.close()
+                #Move into place atomically, so other runs never see a partial entry
+                os.replace(temp_path, path)
+                utilities.prune_lru(self.cache_dir, self.max_size_mb*1000000, suffix=CACHE_SUFFIX)
+        finally:
+            if fp_out is not None:
+                fp_out.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def get_stats(self):
+        stats = dict()
+        stats['hits'] = 0
+        stats['misses'] = 0
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILENAME), 'r') as fp_in:
+                stats.update(json.load(fp_in))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    #Other runs may be updating the stats at the same time
+    def update_stats(self, hit):
+        with utilities.FileLock(os.path.join(self.cache_dir, STATS_LOCK_FILENAME)):
+            stats = self.get_stats()
+            if hit==True:
+                stats['hits'] += 1
+            else:
+                stats['misses'] += 1
+            try:
+                with open(os.path.join(self.cache_dir, STATS_FILENAME), 'w') as fp_out:
+                    json.dump(stats, fp_out)
+            except OSError:
+                pass
+        print("Query cache %s (%d hits, %d misses)." % ("hit" if hit else "miss", stats['hits'], stats['misses']))
+
+    def get_size_mb(self):
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                total_bytes += os.path.getsize(os.path.join(self.cache_dir, name))
+        return total_bytes/1000000.0
@@ -1,6 +1,8 @@
 
 import sys
 import os
+import collections
+import hashlib
 
 #Add one directory level above to path to find imports
 full_path = os.path.abspath(sys.argv[0])
@@ -10,6 +12,8 @@ sys.path.append(path_add)
 import filters
 import data_products
 import models
+import utilities
+import join_planner
 
 class Query:
     field_order = ['Study_Name',
@@ -47,6 +51,12 @@ class Query:
         self.where_clauses = set()
         self.sort = ""
         self.distinct = False
+        #Events to load into the event table, if the event list is joined instead of written into the query
+        self.event_table = None
+        self.fingerprint = None
+        #Planned join order and index hints, from join_planner.order_joins()
+        self.join_order = None
+        self.index_hints = dict()
 
     def add_select(self, select_fields):
         for s in select_fields:
@@ -60,12 +70,14 @@ class Query:
         for f in from_fields:
             self.from_tables.add(f)
 
+    #where_fields are SQL strings, or (SQL, params) tuples with a %s placeholder in the SQL for each param
     def add_where(self, where_fields):
         for w in where_fields:
-            self.where_clauses.add(w)
+            self.where_clauses.add(make_where_clause(w))
 
     def remove_where(self, where_fields):
         for w in where_fields:
+            w = make_where_clause(w)
             if w in self.where_clauses:
                 self.where_clauses.remove(w)
 
@@ -83,16 +95,69 @@ class Query:
         #Sort in alphabetical order so we know the order for tests
         return ",".join(sorted(list(self.from_tables)))
     
+    #Sort in alphabetical order so we know the order for tests; the params must come out in the same order
+    def get_sorted_where_clauses(self):
+        return sorted(list(self.where_clauses), key=lambda w: (w[0], repr(w[1])))
+
     def get_where_string(self):
-        #Sort in alphabetical order so we know the order for tests
-        return " and ".join(sorted(list(self.where_clauses)))
+        return " and ".join([sql for (sql, params) in self.get_sorted_where_clauses()])
+
+    #Returns the values for the placeholders in the where string, in order
+    def get_where_params(self):
+        where_params = []
+        for (sql, params) in self.get_sorted_where_clauses():
+            where_params.extend(params)
+        return tuple(where_params)
 
+    #The query has %s placeholders for the values in get_query_params()
     def get_query_string(self):
         return "select %s from %s where %s" % (self.get_select_string(), self.get_from_string(), self.get_where_string())
 
+    def get_query_params(self):
+        return self.get_where_params()
+
+    def set_event_table(self, event_list):
+        self.event_table = event_list
+
+    def get_event_table(self):
+        return self.event_table
+
     def set_distinct(self, distinct):
         self.distinct = distinct
 
+    def set_join_plan(self, join_order, index_hints):
+        self.join_order = join_order
+        self.index_hints = index_hints
+
+    #Returns the planned join order, or None if there isn't one
+    def get_join_order(self):
+        return self.join_order
+
+    def get_index_hints(self):
+        return self.index_hints
+
+    def set_fingerprint(self, fingerprint):
+        self.fingerprint = fingerprint
+
+    #Returns the RequestFingerprint this query was built from; equal fingerprints mean identical queries
+    def get_fingerprint(self):
+        return self.fingerprint
+
+    #Returns a copy which can be changed without affecting this query
+    def copy(self):
+        query = Query()
+        query.select_fields = set(self.select_fields)
+        query.from_tables = set(self.from_tables)
+        query.where_clauses = set(self.where_clauses)
+        query.sort = self.sort
+        query.distinct = self.distinct
+        query.event_table = self.event_table
+        query.fingerprint = self.fingerprint
+        if self.join_order is not None:
+            query.join_order = list(self.join_order)
+        query.index_hints = dict(self.index_hints)
+        return query
+
     def get_distinct(self):
         return self.distinct
 
@@ -111,79 +176,147 @@ class Query:
                 sorted_select_fields.append(s)
         return sorted_select_fields
 
-    #Makes sure all tables are connected with joins
+    #Makes sure all tables are connected with joins, adding any tables needed to connect them
     def connect_tables(self):
-        table_list = list(self.from_tables)
-        table_list.sort()
-        connected_list = []
-        working_table = table_list.pop(0)
-        while len(table_list)>0:
-            #Run all combos
-            for t in table_list:
-                if t not in connected_list:
-                    #print("Connecting %s and %s." % (working_table, t))
-                    added_tables = self.join_tables(working_table, t)
-                    if len(added_tables)>0:
-                        table_list.extend(added_tables)
-            connected_list.append(working_table)
-            working_table = table_list.pop(0)
-
-    #Adds joins between tables
-    def join_tables(self, table1, table2):
-        added_tables = []
-        if table1==table2:
-            return added_tables
-        if table1>table2:
-            #Swap tables to be in alpha order
-            self.join_tables(table2, table1)
-            return added_tables
-        if table1=="CyberShake_Runs":
-            #CyberShake_Runs, CyberShake_Sites
-            if table2=="CyberShake_Sites":
-                self.add_where(["CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID"])
-            #CyberShake_Runs, Rupture_Variations
-            elif table2=="Rupture_Variations":
-                self.add_where(["CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID", "CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID"])
-            #CyberShake_Runs, Ruptures
-            elif table2=="Ruptures":
-                self.add_where(["CyberShake_Runs.ERF_ID=Ruptures.ERF_ID"])
-            #CyberShake_Runs, PeakAmplitudes
-            elif table2=="PeakAmplitudes":
-                self.add_where(["CyberShake_Runs.Run_ID=PeakAmplitudes.Run_ID"])
-            #CyberShake_Runs, Studies
-            elif table2=="Studies":
-                self.add_where(["CyberShake_Runs.Study_ID=Studies.Study_ID"])
-        elif table1=="CyberShake_Site_Ruptures":
-            #CyberShake_Site_Ruptures, CyberShake_Sites
-            if table2=="CyberShake_Sites":
-                self.add_where(["CyberShake_Site_Ruptures.CS_Site_ID=CyberShake_Sites.CS_Site_ID"])
-            #CyberShake_Site_Ruptures, Ruptures
-            elif table2=="Ruptures":
-                self.add_where(["CyberShake_Site_Ruptures.ERF_ID=Ruptures.ERF_ID", "CyberShake_Site_Ruptures.Source_ID=Ruptures.Source_ID", "CyberShake_Site_Ruptures.Rupture_ID=Ruptures.Rupture_ID"])
-        elif table1=="CyberShake_Sites":
-            if table2=="Studies":
-                added_tables.append("CyberShake_Runs")
-                self.add_from(["CyberShake_Runs"])
-                self.add_where(["CyberShake_Runs.Site_ID=CyberShake_Sites.CS_Site_ID", "CyberShake_Runs.Study_ID=Studies.Study_ID"])
-        elif table1=="IM_Types":
-            if table2=="PeakAmplitudes":
-                self.add_where(["IM_Types.IM_Type_ID=PeakAmplitudes.IM_Type_ID"])
-        elif table1=="PeakAmplitudes":
-            if table2=="Ruptures":
-                self.add_where(["Ruptures.Source_ID=PeakAmplitudes.Source_ID", "Ruptures.Rupture_ID=PeakAmplitudes.Rupture_ID"])
-            elif table2=="Rupture_Variations":
-                self.add_where(["Rupture_Variations.Source_ID=PeakAmplitudes.Source_ID", "Rupture_Variations.Rupture_ID=PeakAmplitudes.Rupture_ID", "Rupture_Variations.Rup_Var_ID=PeakAmplitudes.Rup_Var_ID"])
-        elif table1=="Rupture_Variations":
-            #Rupture_Variations, Ruptures
-            if table2=="Ruptures":
-                self.add_where(["Rupture_Variations.ERF_ID=Ruptures.ERF_ID", "Rupture_Variations.Source_ID=Ruptures.Source_ID", "Rupture_Variations.Rupture_ID=Ruptures.Rupture_ID"])
-        return added_tables
-
-
-def construct_queries(model, dp, filter_list, event_list):
+        try:
+            (added_tables, join_clauses) = join_planner.plan_joins(frozenset(self.from_tables))
+        except join_planner.JoinPlanningError as e:
+            print("Error constructing query: %s  Aborting." % str(e), file=sys.stderr)
+            sys.exit(utilities.ExitCodes.QUERY_CONSTRUCTION_ERROR)
+        self.add_from(added_tables)
+        self.add_where(join_clauses)
+
+
+#Hashable description of a request, for memoizing construct_queries()
+RequestFingerprint = collections.namedtuple('RequestFingerprint', ['model', 'data_product', 'filters', 'event_list_digest', 'event_table', 'dimension_lookup', 'table_stats'])
+FilterFingerprint = collections.namedtuple('FilterFingerprint', ['name', 'filter_params', 'values', 'sort'])
+
+#Maximum number of constructed queries to keep, least recently used are dropped first
+MAX_MEMOIZED_QUERIES = 1024
+#RequestFingerprint -> Query
+query_memo = collections.OrderedDict()
+
+#Where clauses are stored as (SQL, params tuple)
+def make_where_clause(where_field):
+    if isinstance(where_field, str):
+        return (where_field, ())
+    (sql, params) = where_field
+    return (sql, tuple(params))
+
+
+#Returns a (SQL, params) predicate matching any of the values
+def get_in_clause(field, values):
+    if len(values)==1:
+        return ("%s=%%s" % field, [values[0]])
+    return ("%s in (%s)" % (field, ",".join(["%s"]*len(values))), list(values))
+
+#Returns the distinct values as a sorted list of (first, last) runs of consecutive integers
+def get_value_runs(values):
+    runs = []
+    for v in sorted(set(values)):
+        if len(runs)>0 and runs[-1][1]==v-1:
+            runs[-1][1] = v
+        else:
+            runs.append([v, v])
+    return [(first, last) for (first, last) in runs]
+
+#Returns a (SQL, params) predicate matching a set of integers, using between for runs of 3 or more and in for the rest
+def get_int_set_clause(field, values):
+    where_clauses = []
+    where_params = []
+    singles = []
+    for (first, last) in get_value_runs(values):
+        if last-first>=2:
+            where_clauses.append("%s between %%s and %%s" % field)
+            where_params.extend([first, last])
+        else:
+            singles.extend(range(first, last+1))
+    if len(singles)>0:
+        (in_clause, in_params) = get_in_clause(field, singles)
+        where_clauses.append(in_clause)
+        where_params.extend(in_params)
+    if len(where_clauses)==1:
+        return (where_clauses[0], where_params)
+    return ("(%s)" % " or ".join(where_clauses), where_params)
+
+#Returns a (SQL, params) predicate matching the events in event_list, factored by source and then rupture,
+#with the rupture variations of each rupture as ranges and in lists.
+#Both databases accept (Source_ID, Rupture_ID, Rup_Var_ID) in ((...), ...) row-value lists, but this form needs far fewer
+#parameters when variations come in runs, and gives MySQL index range scans on each source and rupture.
+def get_event_clause(event_list):
+    events = dict()
+    for e in event_list:
+        events.setdefault(int(e[0]), dict()).setdefault(int(e[1]), []).append(int(e[2]))
+    source_clauses = []
+    where_params = []
+    for source_id in sorted(events):
+        rupture_clauses = []
+        source_params = [source_id]
+        for rupture_id in sorted(events[source_id]):
+            (rv_clause, rv_params) = get_int_set_clause("Rupture_Variations.Rup_Var_ID", events[source_id][rupture_id])
+            rupture_clauses.append("(Rupture_Variations.Rupture_ID=%%s and %s)" % rv_clause)
+            source_params.append(rupture_id)
+            source_params.extend(rv_params)
+        if len(rupture_clauses)==1:
+            source_clauses.append("(Rupture_Variations.Source_ID=%%s and %s)" % rupture_clauses[0])
+        else:
+            source_clauses.append("(Rupture_Variations.Source_ID=%%s and (%s))" % " or ".join(rupture_clauses))
+        where_params.extend(source_params)
+    return ("(%s)" % " or ".join(source_clauses), where_params)
+
+
+#Returns a hash of the event list, or None if there isn't one
+def get_event_list_digest(event_list):
+    if event_list is None:
+        return None
+    hasher = hashlib.sha256()
+    for e in event_list:
+        hasher.update(("%d,%d,%d\n" % (int(e[0]), int(e[1]), int(e[2]))).encode('utf-8'))
+    return hasher.hexdigest()
+
+#Returns a hashable snapshot of a request.  Filters are mutable and get changed in place, so their values are copied out.
+def get_request_fingerprint(model, dp, filter_list, event_list, event_table=None, dimension_lookup=None, table_stats=None):
+    filter_keys = []
+    for f in filter_list:
+        filter_keys.append(FilterFingerprint(f.get_name(), int(f.get_filter_params()), tuple(f.get_values()), f.get_sort()))
+    return RequestFingerprint(model.get_name(), dp.get_name(), tuple(filter_keys), get_event_list_digest(event_list), event_table, get_source_key(dimension_lookup), get_source_key(table_stats))
+
+#Queries built with IDs or statistics depend on which database they came from, and on which refresh of it they used
+def get_source_key(source):
+    if source is None:
+        return None
+    return (source.cache_path, source.generation)
+
+#Returns a short string identifying the request, for use in filenames or cache keys
+def get_fingerprint_digest(fingerprint):
+    return hashlib.sha256(repr(fingerprint).encode('utf-8')).hexdigest()
+
+
+#If event_table is None, large event lists are joined from a temporary table and small ones are written into the query
+#If dimension_lookup is given, study, site and IM names are resolved to IDs, and the query selects on those instead
+#If table_stats is given, the query also gets a join order and index hints, which the database wrapper uses on MySQL
+#Queries are memoized on the request fingerprint; each call returns a new copy, so callers can change it.
+def construct_queries(model, dp, filter_list, event_list, event_table=None, dimension_lookup=None, table_stats=None):
+    fingerprint = get_request_fingerprint(model, dp, filter_list, event_list, event_table=event_table, dimension_lookup=dimension_lookup, table_stats=table_stats)
+    if fingerprint in query_memo:
+        query_memo.move_to_end(fingerprint)
+        return query_memo[fingerprint].copy()
+    query = build_queries(model, dp, filter_list, event_list, event_table=event_table, dimension_lookup=dimension_lookup, table_stats=table_stats)
+    #Building can refresh the lookup, so key the query on the contents it was actually built from
+    fingerprint = fingerprint._replace(dimension_lookup=get_source_key(dimension_lookup), table_stats=get_source_key(table_stats))
+    query.set_fingerprint(fingerprint)
+    query_memo[fingerprint] = query
+    if len(query_memo)>MAX_MEMOIZED_QUERIES:
+        query_memo.popitem(last=False)
+    return query.copy()
+
+def clear_query_memo():
+    query_memo.clear()
+
+def build_queries(model, dp, filter_list, event_list, event_table=None, dimension_lookup=None, table_stats=None):
     query = Query()
     #Add model
-    (from_tables, where_clauses) = model.get_query()
+    (from_tables, where_clauses) = model.get_query(dimension_lookup=dimension_lookup)
     query.add_from(from_tables)
     query.add_where(where_clauses)
     #Add data product
@@ -196,21 +329,34 @@ def construct_queries(model, dp, filter_list, event_list):
     (metadata_select, metadata_from) = dp.get_metadata_query()
     query.add_select(metadata_select)
     query.add_from(metadata_from)
+    resolved_im_types = False
     for f in filter_list:
         #If we're filtering on IMs, restrict to RotD50, unless it's PGA or PGV
         if f.get_data_product()==filters.FilterDataProducts.IMS:
             query.add_from(["IM_Types"])
             query.add_where(["IM_Types.IM_Type_Component='RotD50'"])
         (where_fields, from_tables) = f.get_query()
-        #print("Filter %s adds from tables %s and where fields %s." % (f.get_name(), from_tables, where_fields))
-        query.add_from(from_tables)
         fp = f.get_filter_params()
-        quote = ""
-        if not f.is_numeric():
-            quote = "'" 
-        if fp==filters.FilterParams.SINGLE_VALUE:
+        #If the values resolve to IDs, select on the key column instead of joining the table with the names
+        ids = None
+        if dimension_lookup is not None and f.get_id_query() is not None and f.get_contains()==False and fp!=filters.FilterParams.VALUE_RANGE:
+            (id_fields, id_tables, dimension) = f.get_id_query()
+            ids = dimension_lookup.get_ids(dimension, f.get_values())
+        #print("Filter %s adds from tables %s and where fields %s." % (f.get_name(), from_tables, where_fields))
+        if ids is None or f.get_sort()!=0:
+            query.add_from(from_tables)
+        #Values are passed as parameters rather than written into the SQL, so requests which differ only in their values share a statement
+        if ids is not None:
+            query.add_from(id_tables)
+            query.add_where([get_in_clause(id_fields[0], ids)])
+            if dimension=='im_type':
+                resolved_im_types = True
+                if fp==filters.FilterParams.SINGLE_VALUE and (f.get_value()=='PGA' or f.get_value()=='PGV'):
+                    query.remove_select(['IM_Types.IM_Type_Value','IM_Types.IM_Type_Component'])
+                    query.add_select(['IM_Types.IM_Type_Measure'])
+        elif fp==filters.FilterParams.SINGLE_VALUE:
             if f.get_contains()==True:
-                query.add_where(["%s LIKE %s%%%s%%%s" % (where_fields[0], quote, f.get_value(), quote)])
+                query.add_where([("%s LIKE %%s" % where_fields[0], ["%%%s%%" % f.get_value()])])
             else:
                 #Check for PGA, PGV - if so, remove the RotD50 match, use 'IM_Type_Measure' for the where,
                 #and change the select from IM_Types.IM_Type_Value and IM_Types.IM_Type_Component to IM_Types.IM_Type_Measure
@@ -218,22 +364,24 @@ def construct_queries(model, dp, filter_list, event_list):
                     query.remove_select(['IM_Types.IM_Type_Value','IM_Types.IM_Type_Component'])
                     query.add_select(['IM_Types.IM_Type_Measure'])
                     query.remove_where(["IM_Types.IM_Type_Component='RotD50'"])
-                    query.add_where(["IM_Type_Measure='%s'" % f.get_value()])
+                    query.add_where([("IM_Type_Measure=%s", [f.get_value()])])
                 else:
-                    query.add_where(["%s=%s%s%s" % (where_fields[0], quote, f.get_value(), quote)])
+                    query.add_where([("%s=%%s" % where_fields[0], [f.get_value()])])
         elif fp==filters.FilterParams.MULTIPLE_VALUES:
-            where_clauses = []
-            for v in f.get_values():
-                if f.get_contains()==True:
-                    where_clauses.append(["%s LIKE %s%%%s%%%s" % (where_fields[0], quote, v, quote)])
-                else:
-                    where_clauses.append("%s=%s%s%s" % (where_fields[0], quote, v, quote))
-            query.add_where(["(%s)" % " or ".join(where_clauses)])
+            if f.get_contains()==True:
+                where_clauses = []
+                where_params = []
+                for v in f.get_values():
+                    where_clauses.append("%s LIKE %%s" % where_fields[0])
+                    where_params.append("%%%s%%" % v)
+                query.add_where([("(%s)" % " or ".join(where_clauses), where_params)])
+            else:
+                query.add_where([get_in_clause(where_fields[0], f.get_values())])
         elif fp==filters.FilterParams.VALUE_RANGE:
             #This filter makes no sense with a contains, so let's not worry about it
             (min, max) = f.get_values()
-            where_clause = "%s>=%s%s%s and %s<=%s%s%s" % (where_fields[0], quote, min, quote, where_fields[0], quote, max, quote)
-            query.add_where([where_clause])
+            where_clause = "%s>=%%s and %s<=%%s" % (where_fields[0], where_fields[0])
+            query.add_where([(where_clause, [min, max])])
         #Check sort
         if f.get_sort()<0:
             #Sort in reverse
@@ -243,15 +391,30 @@ def construct_queries(model, dp, filter_list, event_list):
             #Sort in ascending
             sort_clause = 'order by %s asc' % (f.where_fields[0])
             query.set_sort(sort_clause)
+    #The IM type IDs already pick out the component
+    if resolved_im_types:
+        query.remove_where(["IM_Types.IM_Type_Component='RotD50'"])
     #If specific events are specified, add these
-    if event_list is not None:
+    if event_list is not None and event_table is None:
+        event_table = (len(event_list)>=utilities.EVENT_TABLE_MIN_EVENTS)
+    if event_list is not None and event_table==True:
+        #Join against a temporary table of the events, which the database wrapper creates
+        query.add_from([utilities.EVENT_TABLE_NAME])
+        query.set_event_table(event_list)
+    elif event_list is not None:
         #Use Rupture_Variations table to do the filtering
         query.add_from(["Rupture_Variations"])
-        where_clauses = []
-        for e in event_list:
-            where_clause = '(Rupture_Variations.Source_ID=%d and Rupture_Variations.Rupture_ID=%d and Rupture_Variations.Rup_Var_ID=%d)' % (e[0], e[1], e[2])
-            where_clauses.append(where_clause)
-        query.add_where(['(%s)' % (" OR ".join(where_clauses))])
+        query.add_where([get_event_clause(event_list)])
     #Need to join any unconnected tables
     query.connect_tables()
+    #Bind the rupture tables to the study's ERF and scenario, so they can be filtered by key before the join
+    if dimension_lookup is not None:
+        query.add_where(dimension_lookup.get_study_key_clauses(model.get_name(), query.from_tables))
+    #Drive the join from the most selective table
+    if table_stats is not None:
+        row_counts = dict()
+        if query.get_event_table() is not None:
+            row_counts[utilities.EVENT_TABLE_NAME] = len(query.get_event_table())
+        (join_order, index_hints) = join_planner.order_joins(query.from_tables, query.where_clauses, table_stats, row_counts)
+        query.set_join_plan(join_order, index_hints)
     return query
\ No newline at end of file
@@ -3,9 +3,19 @@
 import sys
 import os
 import argparse
-import urllib.request
 import timeit
 import struct
+import socket
+import ssl
+import http.client
+import urllib.parse
+import threading
+import concurrent.futures
+import mmap
+import functools
+import traceback
+
+import numpy as np
 
 # Add one directory level above to path to find imports
 full_path = os.path.abspath(sys.argv[0])
@@ -13,9 +23,47 @@ path_add = os.path.dirname(os.path.dirname(full_path))
 sys.path.append(path_add)
 
 import utilities
+import seismogram_cache
+import seismogram_container
 
 debug = False
 
+# Number of files to download at once
+DEFAULT_DOWNLOAD_THREADS = 8
+# Number of processes extracting rupture variations; 1 extracts in this process
+DEFAULT_EXTRACT_WORKERS = 1
+# Default most temp space to fill before extracting and deleting, in MB
+DEFAULT_TEMP_BUDGET_MB = 1000
+# Bytes to read from the network and write to disk at a time
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+# Seconds to wait on a stalled connection
+DOWNLOAD_TIMEOUT = 60
+# Attempts per file, for dropped connections
+DOWNLOAD_RETRIES = 3
+MAX_REDIRECTS = 5
+# Most byte ranges to ask for in one request
+MAX_RANGES_PER_REQUEST = 64
+# Offsets of the rupture variation ID and number of timesteps in each record's header
+HEADER_RV_OFFSET = 32
+HEADER_NT_OFFSET = 40
+# Layout of the header before each rupture variation's data
+SEISMOGRAM_HEADER_DTYPE = seismogram_container.SEISMOGRAM_HEADER_DTYPE
+# Entries of a rupture file's RV index, sorted by RV
+RV_INDEX_DTYPE = np.dtype([('rup_var_id', '<i4'), ('nt', '<i4'), ('offset', '<i8')])
+
+# Each download thread keeps one open connection per host, so files from the same Globus endpoint reuse it
+thread_connections = threading.local()
+# (scheme, host) -> record size, for hosts which aren't a known study's endpoint
+record_sizes = dict()
+record_sizes_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    pass
+
+# Errors from the connection, as opposed to errors writing local files, which are OSErrors too
+NETWORK_ERRORS = (http.client.HTTPException, ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError)
+
 def make_abs_dir(folder_name):
     """Create absolute path to a directory one level above and ensure it exists."""
     abs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', folder_name))
@@ -34,6 +82,25 @@ def parse_args(argv):
                         help="Path to output directory to store files in.")
     parser.add_argument('-t', '--temp-directory', dest='temp_directory', action='store', default=".",
                         help="Path to temporary directory to store files before extraction.")
+    parser.add_argument('-b', '--temp-budget-mb', dest='temp_budget_mb', action='store', type=int, default=DEFAULT_TEMP_BUDGET_MB,
+                        help="Most temporary space to use, in MB.  Files are downloaded, extracted and deleted in batches which fit (default: %d)." % DEFAULT_TEMP_BUDGET_MB)
+    parser.add_argument('-n', '--num-threads', dest='num_threads', action='store', type=int, default=DEFAULT_DOWNLOAD_THREADS,
+                        help="Number of files to download at once (default: %d)." % DEFAULT_DOWNLOAD_THREADS)
+    parser.add_argument('-w', '--extract-workers', dest='extract_workers', action='store', type=int, default=DEFAULT_EXTRACT_WORKERS,
+                        help="Number of processes to extract rupture variations with (default: %d)." % DEFAULT_EXTRACT_WORKERS)
+    parser.add_argument('-c', '--container', dest='container', action='store_true', default=False,
+                        help="Write rupture variations into one container per site and run in the output directory, instead of a .grm file each.  Extracts in one process.")
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true', default=False,
+                        help="Extract rupture variations from each download as it arrives, without saving rupture files to the temp directory.")
+    parser.add_argument('--full-files', dest='use_ranges', action='store_false', default=True,
+                        help="Download whole rupture files, instead of just the requested rupture variations with HTTP range requests.")
+    parser.add_argument('--cache', dest='use_cache', action='store_true', default=False,
+                        help="Keep whole rupture files in a local cache shared between runs, and use it before downloading.  Files missing from the cache are downloaded whole, "
+                             "not with range requests.  The cache takes up to --cache-size-mb of disk on top of the temp budget.")
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', default=None,
+                        help="Directory for the seismogram cache (default: %s)." % seismogram_cache.get_default_cache_dir())
+    parser.add_argument('--cache-size-mb', dest='cache_size_mb', action='store', type=int, default=seismogram_cache.MAX_CACHE_SIZE_MB,
+                        help="Size the seismogram cache is pruned to after each batch, in MB (default: %d)." % seismogram_cache.MAX_CACHE_SIZE_MB)
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False,
                         help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False,
@@ -65,102 +132,670 @@ def parse_args(argv):
     os.makedirs(temp_directory, exist_ok=True)
     args_dict['temp_directory'] = temp_directory
 
+    args_dict['num_threads'] = max(1, args.num_threads)
+    args_dict['temp_budget_mb'] = max(1, args.temp_budget_mb)
+    args_dict['use_ranges'] = args.use_ranges
+    args_dict['extract_workers'] = max(1, args.extract_workers)
+    args_dict['stream'] = args.stream
+    args_dict['container'] = args.container
+    args_dict['use_cache'] = args.use_cache
+    args_dict['cache_dir'] = args.cache_dir
+    args_dict['cache_size_mb'] = args.cache_size_mb
+
     if args.debug:
         debug = True
 
     return args_dict
 
-def retrieve_files(args_dict):
+def read_url_lines(input_file):
+    """Return the non-blank lines of the URL file."""
+    with open(input_file, 'r') as fp_in:
+        return [line for line in fp_in if line.strip() != ""]
+
+def parse_url_line(line):
+    """Split a line of the URL file into (url, site name, run ID, rupture file basename, list of RVs)."""
+    url, rvs = line.strip().split()[0:2]
+    _, _, _, site_name, run_id, basename = url.split("/")
+    rv_list = [int(rv) for rv in rvs.split(",")]
+    return (url, site_name, run_id, basename, rv_list)
+
+def get_file_size_hint(line):
+    """Return the rupture file size in bytes which the database wrapper estimated for a line of the URL file, or None."""
+    pieces = line.strip().split()
+    if len(pieces) < 3:
+        return None
+    return int(pieces[2])
+
+def get_http_connection(scheme, host):
+    """Return this thread's open connection to host, making one if needed."""
+    connections = getattr(thread_connections, 'connections', None)
+    if connections is None:
+        connections = dict()
+        thread_connections.connections = connections
+    if (scheme, host) not in connections:
+        if scheme == 'https':
+            connections[(scheme, host)] = http.client.HTTPSConnection(host, timeout=DOWNLOAD_TIMEOUT)
+        else:
+            connections[(scheme, host)] = http.client.HTTPConnection(host, timeout=DOWNLOAD_TIMEOUT)
+    return connections[(scheme, host)]
+
+def close_http_connection(scheme, host):
+    connections = getattr(thread_connections, 'connections', dict())
+    if (scheme, host) in connections:
+        connections.pop((scheme, host)).close()
+
+def http_get(url, headers=None):
+    """Send a GET for url on this thread's kept-alive connection, following redirects, and return the response."""
+    if headers is None:
+        headers = dict()
+    for i in range(MAX_REDIRECTS + 1):
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+        conn = get_http_connection(parsed.scheme, parsed.netloc)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            # The server may have closed the idle connection, so try once more on a new one
+            close_http_connection(parsed.scheme, parsed.netloc)
+            conn = get_http_connection(parsed.scheme, parsed.netloc)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('Location')
+            response.read()
+            if location is None:
+                raise DownloadError("HTTP status %d with no redirect location for %s" % (response.status, url))
+            url = urllib.parse.urljoin(url, location)
+            continue
+        return response
+    raise DownloadError("Too many redirects for %s" % url)
+
+def remove_part_file(temp_filename):
+    """Remove a partly written file, if it was created."""
+    try:
+        os.remove(temp_filename)
+    except OSError:
+        pass
+
+def download_file(url, local_filename):
+    """Stream url to local_filename in chunks, and return the number of bytes written."""
+    parsed = urllib.parse.urlsplit(url)
+    temp_filename = utilities.get_part_filename(local_filename)
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            response = http_get(url)
+            if response.status != 200:
+                response.read()
+                raise DownloadError("HTTP status %d (%s) for %s" % (response.status, response.reason, url))
+            num_bytes = 0
+            with open(temp_filename, 'wb') as fp_out:
+                while True:
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fp_out.write(chunk)
+                    num_bytes += len(chunk)
+            # Only complete files get the real name
+            os.replace(temp_filename, local_filename)
+            return num_bytes
+        except NETWORK_ERRORS as e:
+            # The connection is in an unknown state after a failure partway through
+            close_http_connection(parsed.scheme, parsed.netloc)
+            remove_part_file(temp_filename)
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise DownloadError("%s, after %d attempts" % (str(e), DOWNLOAD_RETRIES))
+            if debug:
+                print("Retrying %s after error: %s" % (url, str(e)))
+        except OSError:
+            remove_part_file(temp_filename)
+            raise
+
+def parse_content_range(value):
+    """Return the (first, last) byte positions from a Content-Range header value."""
+    first, last = value.strip().split()[1].split("/")[0].split("-")
+    if int(last) < int(first):
+        raise DownloadError("Bad Content-Range: %s" % value.strip())
+    return (int(first), int(last))
+
+def parse_byteranges(body, content_type):
+    """Split a multipart/byteranges response body into a list of (first byte position, data)."""
+    boundary = content_type.split("boundary=")[1].split(";")[0].strip().strip('"')
+    delimiter = ("--%s" % boundary).encode('latin1')
+    pieces = []
+    position = body.find(delimiter)
+    while position >= 0:
+        position += len(delimiter)
+        if body[position:position + 2] == b"--":
+            break
+        headers_end = body.find(b"\r\n\r\n", position)
+        if headers_end < 0:
+            raise DownloadError("Malformed multipart range response")
+        content_range = None
+        for header in body[position:headers_end].decode('latin1').split("\r\n"):
+            if header.lower().startswith("content-range:"):
+                content_range = parse_content_range(header.split(":", 1)[1])
+        if content_range is None:
+            raise DownloadError("Multipart range response part has no Content-Range")
+        data_start = headers_end + 4
+        data_end = data_start + content_range[1] - content_range[0] + 1
+        pieces.append((content_range[0], body[data_start:data_end]))
+        position = body.find(delimiter, data_end)
+    return pieces
+
+def fetch_ranges(url, ranges):
+    """Fetch the (first, last) byte ranges of url in one request.
+    Return a list of (first byte position, data), or None if the server sent the whole file instead."""
+    range_header = "bytes=%s" % ",".join(["%d-%d" % (first, last) for (first, last) in ranges])
+    response = http_get(url, headers={'Range': range_header})
+    if response.status == 206:
+        body = response.read()
+        content_type = response.getheader('Content-Type', '')
+        if content_type.startswith("multipart/byteranges"):
+            return parse_byteranges(body, content_type)
+        return [(parse_content_range(response.getheader('Content-Range'))[0], body)]
+    # Rather than read a body we didn't ask for, drop the connection
+    parsed = urllib.parse.urlsplit(url)
+    close_http_connection(parsed.scheme, parsed.netloc)
+    if response.status != 200:
+        raise DownloadError("HTTP status %d (%s) for %s" % (response.status, response.reason, url))
+    return None
+
+def get_record_size(url):
+    """Return the size of each rupture variation record in the file at url, or None if it can't be determined.
+    For unknown hosts this is read from the first record header, once per host."""
+    study_name = utilities.get_study_from_url(url)
+    if study_name is not None:
+        return utilities.get_rv_seismogram_size(study_name)
+    parsed = urllib.parse.urlsplit(url)
+    with record_sizes_lock:
+        if (parsed.scheme, parsed.netloc) in record_sizes:
+            return record_sizes[(parsed.scheme, parsed.netloc)]
+    pieces = fetch_ranges(url, [(0, utilities.SEISMOGRAM_HEADER_SIZE - 1)])
+    record_size = None
+    if pieces is not None and len(pieces) == 1 and len(pieces[0][1]) == utilities.SEISMOGRAM_HEADER_SIZE:
+        nt = struct.unpack('i', pieces[0][1][HEADER_NT_OFFSET:HEADER_NT_OFFSET + 4])[0]
+        record_size = utilities.SEISMOGRAM_HEADER_SIZE + 2 * 4 * nt
+    with record_sizes_lock:
+        record_sizes[(parsed.scheme, parsed.netloc)] = record_size
+    return record_size
+
+def fetch_rv_records(url, rv_list, record_size):
+    """Fetch just the records for rv_list from url with range requests.
+    Assumes record i holds rupture variation i, and checks each header.
+    Return (number of bytes transferred, list of (RV, record) in RV order), or None if the file isn't laid out that way and needs downloading in full."""
+    rvs = sorted(set(rv_list))
+    expected_nt = (record_size - utilities.SEISMOGRAM_HEADER_SIZE) // (2 * 4)
+    # Runs of consecutive RVs are fetched as one range
+    runs = []
+    for rv in rvs:
+        if len(runs) > 0 and runs[-1][1] == rv - 1:
+            runs[-1][1] = rv
+        else:
+            runs.append([rv, rv])
+    ranges = [(first * record_size, (last + 1) * record_size - 1) for (first, last) in runs]
+    num_bytes = 0
+    pieces = []
+    for i in range(0, len(ranges), MAX_RANGES_PER_REQUEST):
+        request_pieces = fetch_ranges(url, ranges[i:i + MAX_RANGES_PER_REQUEST])
+        if request_pieces is None:
+            return None
+        pieces.extend(request_pieces)
+        num_bytes += sum([len(data) for (start, data) in request_pieces])
+    records = []
+    for rv in rvs:
+        offset = rv * record_size
+        record = None
+        # The server may have merged ranges, so look for the piece containing the record
+        for (start, data) in pieces:
+            if start <= offset and offset + record_size <= start + len(data):
+                record = data[offset - start:offset - start + record_size]
+                break
+        if record is None:
+            return None
+        header_rv = struct.unpack('i', record[HEADER_RV_OFFSET:HEADER_RV_OFFSET + 4])[0]
+        header_nt = struct.unpack('i', record[HEADER_NT_OFFSET:HEADER_NT_OFFSET + 4])[0]
+        if header_rv != rv or header_nt != expected_nt:
+            if debug:
+                print("Record %d of %s has RV %d and %d timesteps, not RV %d and %d timesteps; downloading the whole file." % (rv, url, header_rv, header_nt, rv, expected_nt))
+            return None
+        records.append((rv, record))
+    return (num_bytes, records)
+
+def fetch_rv_records_with_ranges(url, rv_list):
+    """Fetch the records for rv_list from url with range requests, if the server and file allow it.
+    Return (number of bytes transferred, list of (RV, record)), or None."""
+    try:
+        record_size = get_record_size(url)
+        if record_size is not None:
+            return fetch_rv_records(url, rv_list, record_size)
+    except (DownloadError, ValueError, IndexError) + NETWORK_ERRORS as e:
+        parsed = urllib.parse.urlsplit(url)
+        close_http_connection(parsed.scheme, parsed.netloc)
+        if debug:
+            print("Range request for %s failed (%s); downloading the whole file." % (url, str(e)))
+    return None
+
+def fetch_rupture_file(url, local_filename, rv_list, use_ranges=True):
+    """Get the requested rupture variations from url into local_filename, with range requests if possible.
+    Return the number of bytes transferred."""
+    if use_ranges:
+        fetched = fetch_rv_records_with_ranges(url, rv_list)
+        if fetched is not None:
+            num_bytes, records = fetched
+            temp_filename = utilities.get_part_filename(local_filename)
+            try:
+                with open(temp_filename, 'wb') as fp_out:
+                    for (rv, record) in records:
+                        fp_out.write(record)
+            except OSError:
+                remove_part_file(temp_filename)
+                raise
+            os.replace(temp_filename, local_filename)
+            return num_bytes
+    return download_file(url, local_filename)
+
+def get_rv_filename(output_directory, site_name, run_id, basename, rv):
+    """Return the output path for one rupture variation's seismogram."""
+    filename_pieces = basename.split(".")[0].split("_")
+    source_id = int(filename_pieces[2])
+    rupture_id = int(filename_pieces[3])
+    return seismogram_container.get_grm_filename(output_directory, site_name, run_id, source_id, rupture_id, rv)
+
+def write_rv(output_directory, site_name, run_id, basename, rv, header, data, container=None):
+    """Write one rupture variation's header and data to its own file, or to the container writer if there is one."""
+    if container is not None:
+        container.add_record(site_name, run_id, header, data)
+        return
+    with open(get_rv_filename(output_directory, site_name, run_id, basename, rv), 'wb') as fp_out:
+        fp_out.write(header)
+        fp_out.write(data)
+
+def read_exactly(response, num_bytes):
+    """Read num_bytes from response, or fewer only if the stream ends."""
+    pieces = []
+    remaining = num_bytes
+    while remaining > 0:
+        piece = response.read(min(remaining, DOWNLOAD_CHUNK_SIZE))
+        if not piece:
+            break
+        pieces.append(piece)
+        remaining -= len(piece)
+    return b"".join(pieces)
+
+def stream_rvs(url, site_name, run_id, basename, rv_list, output_directory, use_ranges=True, container=None):
+    """Extract the requested rupture variations from url straight into output_directory, without saving the rupture file.
+    Records are parsed from the response as they arrive, and unwanted ones are read past and dropped.
+    Return (number of bytes transferred, list of RVs which weren't in the file)."""
+    if use_ranges:
+        fetched = fetch_rv_records_with_ranges(url, rv_list)
+        if fetched is not None:
+            num_bytes, records = fetched
+            for (rv, record) in records:
+                write_rv(output_directory, site_name, run_id, basename, rv, record[:SEISMOGRAM_HEADER_DTYPE.itemsize], record[SEISMOGRAM_HEADER_DTYPE.itemsize:], container)
+            return (num_bytes, [])
+    parsed = urllib.parse.urlsplit(url)
+    remaining = set(rv_list)
+    num_bytes = 0
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            response = http_get(url)
+            if response.status != 200:
+                response.read()
+                raise DownloadError("HTTP status %d (%s) for %s" % (response.status, response.reason, url))
+            while remaining:
+                header_str = read_exactly(response, utilities.SEISMOGRAM_HEADER_SIZE)
+                num_bytes += len(header_str)
+                if len(header_str) < utilities.SEISMOGRAM_HEADER_SIZE:
+                    break
+                rv = struct.unpack('i', header_str[HEADER_RV_OFFSET:HEADER_RV_OFFSET + 4])[0]
+                nt = struct.unpack('i', header_str[HEADER_NT_OFFSET:HEADER_NT_OFFSET + 4])[0]
+                data_size = 2 * 4 * nt
+                if rv in remaining:
+                    rv_data = read_exactly(response, data_size)
+                    num_bytes += len(rv_data)
+                    if len(rv_data) < data_size:
+                        break
+                    write_rv(output_directory, site_name, run_id, basename, rv, header_str, rv_data, container)
+                    remaining.remove(rv)
+                else:
+                    skipped = 0
+                    while skipped < data_size:
+                        chunk = response.read(min(data_size - skipped, DOWNLOAD_CHUNK_SIZE))
+                        if not chunk:
+                            break
+                        skipped += len(chunk)
+                    num_bytes += skipped
+            if not response.isclosed():
+                # Stopped once everything was found, so the rest of the file is still on the connection
+                close_http_connection(parsed.scheme, parsed.netloc)
+            return (num_bytes, sorted(remaining))
+        except NETWORK_ERRORS as e:
+            close_http_connection(parsed.scheme, parsed.netloc)
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise DownloadError("%s, after %d attempts" % (str(e), DOWNLOAD_RETRIES))
+            if debug:
+                print("Retrying %s for RVs %s after error: %s" % (url, str(sorted(remaining)), str(e)))
+
+def get_seismogram_cache(args_dict):
+    """Return the seismogram cache to use, or None if it's turned off."""
+    if not args_dict.get('use_cache', False):
+        return None
+    return seismogram_cache.SeismogramCache(args_dict.get('cache_dir'), args_dict.get('cache_size_mb', seismogram_cache.MAX_CACHE_SIZE_MB))
+
+def retrieve_files(args_dict, cache=None, lines=None):
+    """Download the files in the URL file, or just the given lines of it, through the cache if there is one.
+    Cached files are linked or copied into the temp directory, so another run pruning the cache can't remove them before they're extracted.
+    Return the local path of each file, in URL file order."""
     global debug
-    input_file = args_dict['input_filename']
+    num_threads = args_dict.get('num_threads', DEFAULT_DOWNLOAD_THREADS)
+    use_ranges = args_dict.get('use_ranges', True)
     local_filenames = []
-
-    with open(input_file, 'r') as fp_in:
-        data = fp_in.readlines()
-        num_files = len(data)
-
-        for i, line in enumerate(data):
-            print("Downloading file %d of %d." % (i+1, num_files))
-            url, rvs = line.strip().split()
-            _, _, _, site_name, run_id, basename = url.split("/")
-
-            local_directory = os.path.join(args_dict['temp_directory'], site_name, run_id)
-            os.makedirs(local_directory, exist_ok=True)
-
-            local_filename = os.path.join(local_directory, basename)
-            local_filenames.append(local_filename)
-
+    jobs = []
+
+    if lines is None:
+        lines = read_url_lines(args_dict['input_filename'])
+    for line in lines:
+        url, site_name, run_id, basename, rv_list = parse_url_line(line)
+
+        local_directory = os.path.join(args_dict['temp_directory'], site_name, run_id)
+        os.makedirs(local_directory, exist_ok=True)
+
+        local_filename = os.path.join(local_directory, basename)
+        local_filenames.append(local_filename)
+        jobs.append((url, local_filename, rv_list))
+
+    num_files = len(jobs)
+    print("Downloading %d files, %d at a time." % (num_files, num_threads))
+    start_time = timeit.default_timer()
+    total_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = dict()
+        for (j, (url, local_filename, rv_list)) in enumerate(jobs):
             if debug:
                 print("File URL: %s" % url)
-
-            url_data = urllib.request.urlopen(url).read()
-            with open(local_filename, 'wb') as fp_out:
-                fp_out.write(url_data)
-
+            if cache is not None:
+                futures[executor.submit(cache.fetch_copy, url, download_file, local_filename)] = (url, j)
+            else:
+                futures[executor.submit(fetch_rupture_file, url, local_filename, rv_list, use_ranges)] = (url, j)
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            (url, j) = futures[future]
+            try:
+                total_bytes += future.result()
+            except DownloadError as e:
+                print("Error downloading %s, aborting." % url, file=sys.stderr)
+                print(e, file=sys.stderr)
+                executor.shutdown(wait=True, cancel_futures=True)
+                sys.exit(utilities.ExitCodes.FILE_DOWNLOAD_ERROR)
+            except OSError as e:
+                print("Error writing the download of %s, aborting." % url, file=sys.stderr)
+                print(e, file=sys.stderr)
+                executor.shutdown(wait=True, cancel_futures=True)
+                sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
+            if (i + 1) % 100 == 0 or debug:
+                print("Downloaded file %d of %d." % (i + 1, num_files))
+
+    elapsed = timeit.default_timer() - start_time
+    print("Downloaded %d files, %.1f MB in %.1f sec (%.1f MB/s)." % (num_files, total_bytes / 1e6, elapsed, total_bytes / 1e6 / max(elapsed, 1e-6)))
     return local_filenames
 
-def extract_rvs(args_dict):
-    input_file = args_dict['input_filename']
+def stream_cached_rvs(cache, url, site_name, run_id, basename, rv_list, output_directory, use_ranges=True, container=None):
+    """Extract the requested rupture variations from the cached copy of url if there is one, otherwise stream them.
+    Return (number of bytes transferred, list of RVs which weren't in the file)."""
+    local_rupture_filename = cache.get(url)
+    if local_rupture_filename is None:
+        return stream_rvs(url, site_name, run_id, basename, rv_list, output_directory, use_ranges, container)
+    try:
+        missing_rvs, num_bytes = extract_file_rvs(local_rupture_filename, site_name, run_id, basename, rv_list, output_directory, cache.get_index_path(local_rupture_filename), container)
+    except FileNotFoundError:
+        # Another run evicted it before we opened it; once open, eviction doesn't matter
+        if os.path.exists(local_rupture_filename):
+            raise
+        return stream_rvs(url, site_name, run_id, basename, rv_list, output_directory, use_ranges, container)
+    return (0, missing_rvs)
+
+def stream_files(args_dict, cache=None, container=None):
+    """Download the files in the URL file and extract their rupture variations as they arrive, with nothing written to the temp directory.
+    Files already in the cache are extracted from there; the ones streamed aren't added to it."""
     output_directory = args_dict['output_directory']
+    num_threads = args_dict.get('num_threads', DEFAULT_DOWNLOAD_THREADS)
+    use_ranges = args_dict.get('use_ranges', True)
+    jobs = [parse_url_line(line) for line in read_url_lines(args_dict['input_filename'])]
+
+    num_files = len(jobs)
+    print("Downloading and extracting %d files, %d at a time." % (num_files, num_threads))
+    start_time = timeit.default_timer()
+    total_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = dict()
+        for (url, site_name, run_id, basename, rv_list) in jobs:
+            if debug:
+                print("File URL: %s" % url)
+            if cache is not None:
+                futures[executor.submit(stream_cached_rvs, cache, url, site_name, run_id, basename, rv_list, output_directory, use_ranges, container)] = url
+            else:
+                futures[executor.submit(stream_rvs, url, site_name, run_id, basename, rv_list, output_directory, use_ranges, container)] = url
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            try:
+                num_bytes, missing_rvs = future.result()
+            except DownloadError as e:
+                print("Error downloading %s, aborting." % futures[future], file=sys.stderr)
+                print(e, file=sys.stderr)
+                executor.shutdown(wait=True, cancel_futures=True)
+                sys.exit(utilities.ExitCodes.FILE_DOWNLOAD_ERROR)
+            except OSError as e:
+                print("Error writing rupture variations from %s, aborting." % futures[future], file=sys.stderr)
+                print(e, file=sys.stderr)
+                executor.shutdown(wait=True, cancel_futures=True)
+                sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
+            total_bytes += num_bytes
+            if missing_rvs:
+                print("⚠️ WARNING: Couldn't find rupture variation(s) %s in file %s — skipping those."
+                      % (str(missing_rvs), futures[future]), file=sys.stderr)
+            if (i + 1) % 100 == 0 or debug:
+                print("Extracted file %d of %d." % (i + 1, num_files))
+
+    elapsed = timeit.default_timer() - start_time
+    print("Downloaded %d files, %.1f MB in %.1f sec (%.1f MB/s)." % (num_files, total_bytes / 1e6, elapsed, total_bytes / 1e6 / max(elapsed, 1e-6)))
+    print("Finished extracting rupture variations to %s." % output_directory)
 
-    with open(input_file, 'r') as fp_in:
-        data = fp_in.readlines()
-        num_files = len(data)
+def get_record_offsets(mm):
+    """Return (RV IDs, byte offsets, record sizes) of the records in a memory-mapped rupture file.
+    When every record has the same length, which is usual, the headers are read all at once as a strided array."""
+    header_size = SEISMOGRAM_HEADER_DTYPE.itemsize
+    file_size = len(mm)
+    first_header = np.frombuffer(mm, dtype=SEISMOGRAM_HEADER_DTYPE, count=1, offset=0).copy()[0]
+    record_size = header_size + 2 * 4 * int(first_header['nt'])
+    if record_size > header_size and file_size % record_size == 0:
+        num_records = file_size // record_size
+        headers = np.ndarray(shape=(num_records,), dtype=SEISMOGRAM_HEADER_DTYPE, buffer=mm, offset=0, strides=(record_size,))
+        if np.all(headers['nt'] == first_header['nt']):
+            return (headers['rup_var_id'].copy(), np.arange(num_records, dtype=np.int64) * record_size, np.full(num_records, record_size, dtype=np.int64))
+    # Records of different lengths, so walk them one at a time
+    rv_ids = []
+    offsets = []
+    record_sizes = []
+    offset = 0
+    while offset + header_size <= file_size:
+        header = np.frombuffer(mm, dtype=SEISMOGRAM_HEADER_DTYPE, count=1, offset=offset).copy()[0]
+        size = header_size + 2 * 4 * int(header['nt'])
+        if size <= header_size or offset + size > file_size:
+            break
+        rv_ids.append(int(header['rup_var_id']))
+        offsets.append(offset)
+        record_sizes.append(size)
+        offset += size
+    return (np.array(rv_ids, dtype=np.int32), np.array(offsets, dtype=np.int64), np.array(record_sizes, dtype=np.int64))
+
+def build_rv_index(mm):
+    """Return the RV index of a memory-mapped rupture file: one entry per RV, for its first record, sorted by RV."""
+    rv_ids, offsets, record_sizes = get_record_offsets(mm)
+    unique_rvs, first_positions = np.unique(rv_ids, return_index=True)
+    index = np.empty(len(unique_rvs), dtype=RV_INDEX_DTYPE)
+    index['rup_var_id'] = unique_rvs
+    index['nt'] = (record_sizes[first_positions] - SEISMOGRAM_HEADER_DTYPE.itemsize) // (2 * 4)
+    index['offset'] = offsets[first_positions]
+    return index
+
+def load_rv_index(index_filename, file_size):
+    """Return the saved RV index, or None if there isn't one or it doesn't fit a file of file_size bytes."""
+    try:
+        with open(index_filename, 'rb') as fp_in:
+            index = np.load(fp_in, allow_pickle=False)
+    except (OSError, ValueError, EOFError):
+        return None
+    if index.dtype != RV_INDEX_DTYPE or index.ndim != 1:
+        return None
+    # Lookups binary search it
+    if np.any(np.diff(index['rup_var_id']) <= 0):
+        return None
+    ends = index['offset'] + SEISMOGRAM_HEADER_DTYPE.itemsize + 2 * 4 * index['nt'].astype(np.int64)
+    if len(index) > 0 and (index['offset'].min() < 0 or ends.max() > file_size):
+        return None
+    return index
+
+def save_rv_index(index_filename, index):
+    """Save an RV index, replacing any old one in one step so concurrent runs never read half of it."""
+    temp_filename = utilities.get_part_filename(index_filename)
+    try:
+        with open(temp_filename, 'wb') as fp_out:
+            np.save(fp_out, index, allow_pickle=False)
+        os.replace(temp_filename, index_filename)
+    except OSError as e:
+        print("Warning: couldn't save rupture variation index %s: %s" % (index_filename, str(e)))
+
+def lookup_rvs(mm, index, rvs):
+    """Return the index entries for the RVs in rvs which are in the file.
+    Returns None if the header at any entry's offset doesn't match, meaning the index is stale."""
+    rvs = np.array(sorted(rvs), dtype=np.int64)
+    positions = np.searchsorted(index['rup_var_id'], rvs)
+    positions = positions[positions < len(index)]
+    entries = index[positions]
+    entries = entries[np.isin(entries['rup_var_id'], rvs)]
+    for entry in entries:
+        header = np.frombuffer(mm, dtype=SEISMOGRAM_HEADER_DTYPE, count=1, offset=int(entry['offset'])).copy()[0]
+        if header['rup_var_id'] != entry['rup_var_id'] or header['nt'] != entry['nt']:
+            return None
+    return entries
+
+def extract_file_rvs(local_rupture_filename, site_name, run_id, basename, rv_list, output_directory, index_filename=None, container=None):
+    """Write the records for rv_list in a local rupture file to output_directory.
+    The file is memory-mapped, and each record is written straight from the map.
+    The map can't be closed while anything still refers to it, so if an error escapes, the frames holding views of it are cleared first;
+    otherwise closing it raises BufferError in place of the real error.
+    With index_filename, the RV index saved there is used to go straight to the records, and is built and saved if needed.
+    Return (list of RVs which weren't found, number of bytes written)."""
+    remaining = set(rv_list)
+    num_bytes = 0
+    with open(local_rupture_filename, 'rb') as fp_rup_in:
+        file_size = os.fstat(fp_rup_in.fileno()).st_size
+        if file_size < SEISMOGRAM_HEADER_DTYPE.itemsize:
+            return (sorted(remaining), num_bytes)
+        with mmap.mmap(fp_rup_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                entries = None
+                if index_filename is not None:
+                    index = load_rv_index(index_filename, file_size)
+                    if index is not None:
+                        entries = lookup_rvs(mm, index, remaining)
+                if entries is None:
+                    index = build_rv_index(mm)
+                    if index_filename is not None:
+                        save_rv_index(index_filename, index)
+                    entries = lookup_rvs(mm, index, remaining)
+                with memoryview(mm) as view:
+                    for entry in entries:
+                        rv = int(entry['rup_var_id'])
+                        if debug:
+                            print(f"Found RV: {rv} in file {basename}")
+                        start = int(entry['offset'])
+                        record_size = SEISMOGRAM_HEADER_DTYPE.itemsize + 2 * 4 * int(entry['nt'])
+                        write_rv(output_directory, site_name, run_id, basename, rv, view[start:start + SEISMOGRAM_HEADER_DTYPE.itemsize],
+                                 view[start + SEISMOGRAM_HEADER_DTYPE.itemsize:start + record_size], container)
+                        remaining.remove(rv)
+                        num_bytes += record_size
+            except BaseException as e:
+                traceback.clear_frames(e.__traceback__)
+                raise
+    return (sorted(remaining), num_bytes)
+
+def extract_job(job, container=None):
+    """Extract one rupture file's RVs, possibly in a worker process.
+    job is (local file, site name, run ID, basename, RVs, output directory, index file).
+    Return (list of RVs which weren't found, number of RVs written, number of bytes written)."""
+    (local_rupture_filename, site_name, run_id, basename, rv_list, output_directory, index_filename) = job
+    missing_rvs, num_bytes = extract_file_rvs(local_rupture_filename, site_name, run_id, basename, rv_list, output_directory, index_filename, container)
+    return (missing_rvs, len(set(rv_list)) - len(missing_rvs), num_bytes)
+
+def extract_rvs(args_dict, local_filenames=None, cache=None, lines=None, container=None):
+    """Extract the requested rupture variations from the downloaded files, for the URL file or just the given lines of it.
+    local_filenames is what retrieve_files() returned; without it, the files are looked for in the temp directory.
+    Files from the cache keep an RV index alongside, so later requests for other RVs don't rescan them.
+    With more than one extract worker, files are spread over a process pool; output is the same either way.
+    With a container writer, records go to it instead of a file each, and extraction stays in this process, which owns the writer.
+    Return a summary dict of files, RVs, bytes, missing RVs and seconds."""
+    output_directory = args_dict['output_directory']
+    num_workers = args_dict.get('extract_workers', DEFAULT_EXTRACT_WORKERS)
 
-        for i, line in enumerate(data):
-            if i % 100 == 0:
-                print("Extracting rupture variations from file %d of %d." % (i + 1, num_files))
+    jobs = []
+    if lines is None:
+        lines = read_url_lines(args_dict['input_filename'])
 
-            url, rvs = line.strip().split()
-            _, _, _, site_name, run_id, basename = url.split("/")
-            rv_list = [int(rv) for rv in rvs.split(",")]
+    for i, line in enumerate(lines):
+        url, site_name, run_id, basename, rv_list = parse_url_line(line)
 
+        if local_filenames is not None:
+            local_rupture_filename = local_filenames[i]
+        else:
             local_rupture_directory = os.path.join(args_dict['temp_directory'], site_name, run_id)
             local_rupture_filename = os.path.join(local_rupture_directory, basename)
 
-            sizeof_float = 4
-            num_components = 2
-            found_rvs = []
-
-            with open(local_rupture_filename, 'rb') as fp_rup_in:
-                while rv_list:
-                    header_str = fp_rup_in.read(56)
-                    if header_str == b'':
-                        break
-
-                    rv = struct.unpack('i', header_str[32:36])[0]
-                    nt = struct.unpack('i', header_str[40:44])[0]
-
-                    print(f"Found RV: {rv} in file {basename}")  # <-- Log every RV found
-
-                    if rv in rv_list:
-                        rv_data = fp_rup_in.read(num_components * sizeof_float * nt)
-
-                        filename_pieces = basename.split(".")[0].split("_")
-                        source_id = int(filename_pieces[2])
-                        rupture_id = int(filename_pieces[3])
-
-                        local_rv_filename = os.path.join(
-                            output_directory,
-                            f"Seismogram_{site_name}_{run_id}_{source_id}_{rupture_id}_{rv}.grm"
-                        )
-
-                        with open(local_rv_filename, 'wb') as fp_out:
-                            fp_out.write(header_str)
-                            fp_out.write(rv_data)
-
-                        found_rvs.append(rv)
-                        rv_list.remove(rv)
-                    else:
-                        # Skip over data block if RV is not in list
-                        fp_rup_in.seek(num_components * sizeof_float * nt, 1)
-
-                if rv_list:
-                    print("⚠️ WARNING: Couldn't find rupture variation(s) %s in file %s — skipping those."
-                          % (str(rv_list), local_rupture_filename), file=sys.stderr)
-
+        index_filename = None
+        if cache is not None:
+            index_filename = cache.get_index_path_for_url(url)
+        jobs.append((local_rupture_filename, site_name, run_id, basename, rv_list, output_directory, index_filename))
+
+    num_files = len(jobs)
+    start_time = timeit.default_timer()
+    if num_workers > 1 and num_files > 1 and container is None:
+        print("Extracting rupture variations from %d files with %d processes." % (num_files, num_workers))
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+        # map() keeps the results in file order
+        results = executor.map(extract_job, jobs, chunksize=max(1, num_files // (num_workers * 4)))
+    else:
+        executor = None
+        results = map(functools.partial(extract_job, container=container), jobs)
+
+    summary = dict()
+    summary['files'] = num_files
+    summary['rvs'] = 0
+    summary['bytes'] = 0
+    summary['missing_rvs'] = 0
+    warnings = []
+    try:
+        for i, (missing_rvs, num_rvs, num_bytes) in enumerate(results):
+            if i % 100 == 0:
+                print("Extracting rupture variations from file %d of %d." % (i + 1, num_files))
+            summary['rvs'] += num_rvs
+            summary['bytes'] += num_bytes
+            if missing_rvs:
+                summary['missing_rvs'] += len(missing_rvs)
+                warnings.append((missing_rvs, jobs[i][0]))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    summary['seconds'] = timeit.default_timer() - start_time
+
+    for (missing_rvs, local_rupture_filename) in warnings:
+        print("⚠️ WARNING: Couldn't find rupture variation(s) %s in file %s — skipping those."
+              % (str(missing_rvs), local_rupture_filename), file=sys.stderr)
+    if warnings:
+        print("⚠️ WARNING: %d rupture variation(s) missing from %d file(s)." % (summary['missing_rvs'], len(warnings)), file=sys.stderr)
+    print("Extracted %d rupture variations, %.1f MB, from %d files in %.1f sec." % (summary['rvs'], summary['bytes'] / 1e6, summary['files'], summary['seconds']))
     print("Finished extracting rupture variations to %s." % output_directory)
-
+    return summary
 
 
 def delete_temp_files(temp_directory, local_filenames):
@@ -169,11 +804,72 @@ def delete_temp_files(temp_directory, local_filenames):
         if 'Seismogram' in f and f.endswith('.grm'):
             os.remove(f)
 
+def get_download_estimate(line):
+    """Estimate the most bytes a line of the URL file can take on disk until it's extracted.
+    This is the whole file, even with range requests, since fetch_rupture_file() downloads the whole file whenever ranges fail."""
+    url, site_name, run_id, basename, rv_list = parse_url_line(line)
+    study_name = utilities.get_study_from_url(url)
+    record_size = None
+    if study_name is not None:
+        record_size = utilities.get_rv_seismogram_size(study_name)
+    size_hint = get_file_size_hint(line)
+    if size_hint is not None:
+        return size_hint
+    if record_size is not None:
+        # At least big enough to hold the highest RV asked for
+        return record_size * (max(rv_list) + 1)
+    return 0
+
+def make_windows(lines, budget_bytes):
+    """Split the URL file lines into consecutive windows whose estimated downloads fit in budget_bytes.
+    A file bigger than the budget gets a window to itself."""
+    windows = []
+    window = []
+    window_bytes = 0
+    for line in lines:
+        estimate = get_download_estimate(line)
+        if len(window) > 0 and window_bytes + estimate > budget_bytes:
+            windows.append(window)
+            window = []
+            window_bytes = 0
+        window.append(line)
+        window_bytes += estimate
+    if len(window) > 0:
+        windows.append(window)
+    return windows
+
+def run_windows(args_dict, cache=None, container=None):
+    """Download, extract and delete the files in windows sized to the temp space budget, so temp usage stays under it however large the request is."""
+    lines = read_url_lines(args_dict['input_filename'])
+    windows = make_windows(lines, args_dict.get('temp_budget_mb', DEFAULT_TEMP_BUDGET_MB) * 1000000)
+    for (i, window) in enumerate(windows):
+        if len(windows) > 1:
+            print("Processing batch %d of %d (%d files)." % (i + 1, len(windows), len(window)))
+        local_filenames = retrieve_files(args_dict, cache, window)
+        extract_rvs(args_dict, local_filenames, cache, window, container)
+        delete_temp_files(args_dict['temp_directory'], local_filenames)
+        if container is not None:
+            container.flush()
+        if cache is not None:
+            cache.prune()
+
 def run_main(argv):
     args_dict = parse_args(argv)
-    local_filenames = retrieve_files(args_dict)
-    extract_rvs(args_dict)
-    delete_temp_files(args_dict['temp_directory'], local_filenames)
+    cache = get_seismogram_cache(args_dict)
+    container = None
+    if args_dict.get('container', False):
+        container = seismogram_container.ContainerWriter(args_dict['output_directory'])
+    try:
+        if args_dict.get('stream', False):
+            stream_files(args_dict, cache, container)
+        else:
+            run_windows(args_dict, cache, container)
+    finally:
+        # Also on the way out of an error exit, so the records extracted so far are kept
+        if container is not None:
+            container.close()
+    if cache is not None:
+        cache.finish()
 
 if __name__ == "__main__":
     run_main(sys.argv[1:])
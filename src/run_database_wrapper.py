@@ -6,6 +6,21 @@ import pymysql
 import datetime
 import sqlite3
 import timeit
+import itertools
+import decimal
+import numpy as np
+import csv
+import heapq
+import queue
+import threading
+import gzip
+import io
+import json
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from pymysql.constants import FIELD_TYPE
 
 #Add one directory level above to path to find imports
 full_path = os.path.abspath(sys.argv[0])
@@ -15,20 +30,69 @@ sys.path.append(path_add)
 import utilities
 import filters
 import data_products
+import rv_counts
+import columnar_output
+import query_cache
+import db_connection
 
 #Maximum size of temporary storage, in MB
 MAX_TEMP_DATA_MB = 1000
 #Maximum size of output seismograms, in MB
 MAX_OUTPUT_DATA_MB = 1000
+#Number of rows to fetch at a time when streaming results
+STREAM_BATCH_SIZE = 10000
+#Number of rows to format at a time when writing CSV output
+CSV_BATCH_SIZE = 10000
+#Write buffer size for CSV output, in bytes
+CSV_BUFFER_SIZE = 8*1024*1024
+GZIP_COMPRESSION_LEVEL = 6
+ZSTD_COMPRESSION_LEVEL = 3
+#Number of rows per executemany() call when writing SQLite output
+SQLITE_INSERT_BATCH_SIZE = 50000
+#Page cache size to use when writing SQLite output, in KB
+SQLITE_CACHE_SIZE_KB = 256000
+#Number of rows to convert to arrays at a time when writing columnar output
+COLUMNAR_BATCH_SIZE = 100000
+#Requests estimated to return more than this many rows are refused without --force
+MAX_QUERY_ROWS = 50000000
+#Requests estimated to return more than this many rows get a warning
+WARN_QUERY_ROWS = 5000000
+#Number of rows to sample when estimating output sizes
+ESTIMATE_SAMPLE_ROWS = 1000
+#Rough figures for estimating output size and fetch time
+CSV_COMPRESSION_RATIO_ESTIMATE = 0.2
+SQLITE_OVERHEAD_ESTIMATE = 1.3
+ESTIMATED_FETCH_ROWS_PER_SEC = 100000.0
+#Number of partitions to run at once with --partition-by, and the most we'll open connections for
+DEFAULT_PARALLEL_QUERIES = 4
+MAX_PARALLEL_QUERIES = 16
+#Number of row batches each partition can queue up ahead of the merge
+PARTITION_QUEUE_BATCHES = 4
+#Seconds a partition waits for room on its queue before checking whether it's been stopped
+PARTITION_PUT_TIMEOUT = 1.0
+#Number of events to insert per executemany() call when loading the event table
+EVENT_TABLE_BATCH_SIZE = 10000
+#Number of ruptures to count rupture variations for per query, when the built-in DB can't be used
+NUM_RVS_CHUNK_SIZE = 1000
 
-globus_dict = dict()
-globus_dict['Study 15.12'] = "https://g-41ed52.a78b8.36fe.data.globus.org"
-globus_dict['Study 22.12 LF'] = "https://g-be1d0b.a78b8.36fe.data.globus.org"
-globus_dict['Study 22.12 BB'] = "https://g-2d87a9.a78b8.36fe.data.globus.org"
+#Columns to split requests on for each partition key, as (table, field) in order of preference
+#The last entry is the small lookup table the IDs are read from
+partition_columns = dict()
+partition_columns['site'] = [("CyberShake_Runs", "Site_ID"), ("CyberShake_Site_Ruptures", "CS_Site_ID"), ("CyberShake_Sites", "CS_Site_ID")]
+partition_columns['im_type'] = [("PeakAmplitudes", "IM_Type_ID"), ("IM_Types", "IM_Type_ID")]
+partition_columns['source'] = [("PeakAmplitudes", "Source_ID"), ("CyberShake_Site_Ruptures", "Source_ID"), ("Rupture_Variations", "Source_ID"), ("Ruptures", "Source_ID")]
 
-suffix_dict = dict()
-suffix_dict['Study 15.12'] = "_bb"
-suffix_dict['Study 22.12 BB'] = "_bb"
+#Compressed CSV output formats, and the compression they use
+csv_compression_dict = dict()
+csv_compression_dict['csv.gz'] = 'gzip'
+csv_compression_dict['csv.zst'] = 'zstd'
+
+#MySQL column type codes, for mapping to output column types
+mysql_int_types = [FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.LONGLONG, FIELD_TYPE.INT24, FIELD_TYPE.YEAR]
+mysql_float_types = [FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE, FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL]
+
+#MySQL DECIMAL columns come back as Decimal objects, which SQLite can't store directly
+sqlite3.register_adapter(decimal.Decimal, float)
 
 debug = False
 
@@ -42,7 +106,18 @@ def parse_args(argv):
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to query file describing the data request.")
     parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to output file, with query results.")
     parser.add_argument('-c', "--config-filename", dest='config_filename', action='store', default=None, help="Path to database configuration file.")
-    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results (either "csv" or "sqlite")')
+    parser.add_argument('-of', '--output-format', dest='output_format', action='store', default='csv', help='Output format for database results ("csv", "csv.gz", "csv.zst", "sqlite", or "columnar")')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true', default=False, help='Stream results from the database to the output file in batches, instead of loading them all into memory first.')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', action='store', type=int, default=STREAM_BATCH_SIZE, help='Number of rows to fetch at a time when streaming (default: %d).' % STREAM_BATCH_SIZE)
+    parser.add_argument('-p', '--partition-by', dest='partition_key', action='store', default=None, choices=list(partition_columns.keys()), help='Split the query into pieces by site, IM type, or source ID ranges, and run them in parallel.')
+    parser.add_argument('-j', '--parallel', dest='num_partitions', action='store', type=int, default=DEFAULT_PARALLEL_QUERIES, help='Number of partitions to run in parallel with --partition-by (default: %d, max: %d).' % (DEFAULT_PARALLEL_QUERIES, MAX_PARALLEL_QUERIES))
+    parser.add_argument('--estimate', dest='estimate', action='store', nargs='?', const='explain', default=None, choices=['explain', 'count'], help='Estimate the rows, output size and fetch time of the request and exit, without retrieving it.  "explain" (default) uses the MySQL EXPLAIN estimates, "count" runs an exact COUNT(*).')
+    parser.add_argument('--force', dest='force', action='store_true', default=False, help='Run the request even if it is estimated to return more than %d rows.' % MAX_QUERY_ROWS)
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=True, help='Always query the database, without reading or writing the local query results cache.')
+    parser.add_argument('--refresh', dest='refresh_cache', action='store_true', default=False, help='Query the database even if the results are cached, and replace the cached results.')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', default=None, help='Directory for the query results cache (default: %s).' % query_cache.get_default_cache_dir())
+    parser.add_argument('--use-hints', dest='use_hints', action='store_true', default=False, help='On MySQL, force the join order and driving table index in the query file, instead of letting MySQL plan the query.  Use --compare-plans to check which is faster first.')
+    parser.add_argument('--compare-plans', dest='compare_plans', action='store_true', default=False, help='Run the request with the planned join order and with the database\'s own plan, report how long each took, and exit.')
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args = parser.parse_args(args=argv)
@@ -67,6 +142,17 @@ def parse_args(argv):
     args_dict['output_filename'] = output_filename
     args_dict['config_filename'] = args.config_filename
     args_dict['output_format'] = args.output_format
+    args_dict['stream'] = args.stream
+    args_dict['batch_size'] = args.batch_size
+    args_dict['partition_key'] = args.partition_key
+    args_dict['num_partitions'] = args.num_partitions
+    args_dict['estimate'] = args.estimate
+    args_dict['force'] = args.force
+    args_dict['use_cache'] = args.use_cache
+    args_dict['refresh_cache'] = args.refresh_cache
+    args_dict['cache_dir'] = args.cache_dir
+    args_dict['use_hints'] = args.use_hints
+    args_dict['compare_plans'] = args.compare_plans
     return args_dict
 
 def read_input(input_filename):
@@ -85,90 +171,532 @@ def read_input(input_filename):
         sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
     return input_dict
 
-def execute_queries(config_dict, input_dict):
+#If config_dict is a MySQL database and the query file has a planned join order, the query forces that order and uses the index hints
+def get_query_string(input_dict, config_dict=None):
+    if config_dict is not None and config_dict['type'].lower()=='mysql' and 'join_order' in input_dict:
+        (select_string, from_string) = get_planned_clauses(input_dict)
+    else:
+        (select_string, from_string) = (input_dict['select'], input_dict['from'])
+    query = 'select %s from %s where %s' % (select_string, from_string, input_dict['where'])
+    if 'sort' in input_dict:
+        query = "%s %s" % (query, input_dict['sort'])
+    return query
 
-    #print("Executing database queries.")
-    if (debug):
+#Returns the select and from clauses with STRAIGHT_JOIN and the tables in the planned order, with the driving table's index hint
+def get_planned_clauses(input_dict):
+    select_string = input_dict['select'].strip()
+    #STRAIGHT_JOIN goes after DISTINCT
+    if select_string.lower().startswith("distinct"):
+        select_string = "distinct STRAIGHT_JOIN %s" % select_string[len("distinct"):].strip()
+    else:
+        select_string = "STRAIGHT_JOIN %s" % select_string
+    index_hints = json.loads(input_dict.get('index_hints', '{}'))
+    from_tables = []
+    for t in input_dict['join_order'].split(","):
+        t = t.strip()
+        if t in index_hints:
+            from_tables.append("%s USE INDEX (%s)" % (t, index_hints[t]))
+        else:
+            from_tables.append(t)
+    return (select_string, ",".join(from_tables))
+
+#Returns a copy of input_dict without the planned join order, so the database picks its own
+def remove_join_plan(input_dict):
+    default_dict = dict(input_dict)
+    for k in ['join_order', 'index_hints']:
+        if k in default_dict:
+            del default_dict[k]
+    return default_dict
+
+#Runs the request with the planned join order and with the database's own plan, and reports how long each took
+def compare_plans(config_dict, input_dict, batch_size=STREAM_BATCH_SIZE):
+    if config_dict['type'].lower()!='mysql' or 'join_order' not in input_dict:
+        print("The planned join order is only used on MySQL, with a query file built with table statistics, so both runs will use the same plan.")
+    timings = []
+    for (label, plan_dict) in [("planned", input_dict), ("default", remove_join_plan(input_dict))]:
+        if (debug):
+            print(get_query_string(plan_dict, config_dict))
         start_time = timeit.default_timer()
+        num_rows = 0
+        for row in execute_queries(config_dict, plan_dict, stream=True, batch_size=batch_size):
+            num_rows += 1
+        elapsed = timeit.default_timer()-start_time
+        timings.append(elapsed)
+        print("%s plan: %d rows in %.2f sec." % (label.capitalize(), num_rows, elapsed))
+    if timings[0]>0:
+        print("The default plan took %.2fx as long as the planned one." % (timings[1]/timings[0]))
+
+#Returns the values for the %s placeholders in the where clause
+def get_query_params(input_dict):
+    if 'params' not in input_dict:
+        return ()
+    return tuple(json.loads(input_dict['params']))
+
+#Query strings use pymysql's %s placeholders; SQLite wants ?
+#The query text only depends on the shape of the request, so the statement can be reused: sqlite3 keeps a per-connection
+#cache of compiled statements, and on MySQL identical statement text shares one digest in the server's statistics.
+def execute_query(cur, config_dict, query, params=()):
+    if len(params)==0:
+        #Query files from before parameters were added may have literal % signs
+        cur.execute(query)
+        return
+    if config_dict['type'].lower()=='sqlite':
+        query = query.replace('%s', '?')
+    cur.execute(query, params)
+
+#Reads the events for the event table, written by the query builder
+def read_event_table(event_filename):
+    event_list = []
     try:
-        if config_dict['type'].lower()=='mysql':
-            conn = pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
-        elif config_dict['type'].lower()=='sqlite':
-            conn = sqlite3.connect(config_dict['db_path'])
-        else:
-            print("Database type %s not recognized, aborting.", file=sys.stderr)
-            sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
+        with open(event_filename, 'r') as fp_in:
+            for line in fp_in:
+                pieces = line.strip().split(",")
+                if len(pieces)<3:
+                    continue
+                event_list.append((int(pieces[0]), int(pieces[1]), int(pieces[2])))
+            fp_in.close()
     except Exception as e:
-        error_str = "Error connecting to %s database" % config_dict['type']
-        if config_dict['type'].lower()=='mysql':
-            error_str = "%s %s on host %s with username %s and password %s, aborting." % (error_str, config_dict['db'], config_dict['host'], config_dict['user'], config_dict['password'])
-        elif config_dict['type'].lower()=='sqlite':
-            error_str = "%s %s, aborting." % (error_str, config_dict['db_path'])
-        print(error_str, file=sys.stderr)
+        print("Error reading event list from %s, aborting." % event_filename, file=sys.stderr)
         print(e)
-        sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
-    #Use DictCursor in case we're retrieving seismograms
-    cur = conn.cursor(cursor=pymysql.cursors.DictCursor)
-    query = 'select %s from %s where %s' % (input_dict['select'], input_dict['from'], input_dict['where'])
-    if 'sort' in input_dict:
-        query = "%s %s" % (query, input_dict['sort'])
+        sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
+    return event_list
+
+#Loads the event list into a temporary table on this connection, indexed on the event IDs, so the query can join against it
+def load_event_table(conn, config_dict, event_filename):
+    event_list = read_event_table(event_filename)
+    if (debug):
+        print("Loading %d events into temporary table %s." % (len(event_list), utilities.EVENT_TABLE_NAME))
+    cur = conn.cursor()
+    create_table_cmd = 'CREATE TEMPORARY TABLE %s (Source_ID INTEGER NOT NULL, Rupture_ID INTEGER NOT NULL, Rup_Var_ID INTEGER NOT NULL, ' \
+        'PRIMARY KEY (Source_ID, Rupture_ID, Rup_Var_ID))' % utilities.EVENT_TABLE_NAME
+    if config_dict['type'].lower()=='mysql':
+        insert_cmd = 'INSERT IGNORE INTO %s VALUES (%%s, %%s, %%s)' % utilities.EVENT_TABLE_NAME
+    else:
+        insert_cmd = 'INSERT OR IGNORE INTO %s VALUES (?, ?, ?)' % utilities.EVENT_TABLE_NAME
+    try:
+        cur.execute(create_table_cmd)
+        for i in range(0, len(event_list), EVENT_TABLE_BATCH_SIZE):
+            cur.executemany(insert_cmd, event_list[i:i+EVENT_TABLE_BATCH_SIZE])
+        conn.commit()
+    except Exception as e:
+        print("Error loading event list into temporary table %s, aborting.  The database user needs permission to create temporary tables." % utilities.EVENT_TABLE_NAME, file=sys.stderr)
+        print(e)
+        cur.close()
+        conn.close()
+        sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+    cur.close()
+
+#Returns a QueryResults object.  If stream is True, its rows are fetched in batches from an unbuffered cursor as they're iterated over, instead of all at once.
+#conn is a connection from get_query_connection() to reuse, which is closed when the results have been read.
+#If report_empty is False, no message is printed when there are no results.
+def execute_queries(config_dict, input_dict, stream=False, batch_size=STREAM_BATCH_SIZE, conn=None, report_empty=True):
+
+    #print("Executing database queries.")
+    if (debug):
+        start_time = timeit.default_timer()
+    if conn is None:
+        conn = get_query_connection(config_dict, input_dict)
+    cur = db_connection.get_cursor(conn, config_dict, stream=stream)
+    query = get_query_string(input_dict, config_dict)
     if debug==True:
         print(query)
+        print(get_query_params(input_dict))
     try:
-        cur.execute(query)
+        execute_query(cur, config_dict, query, get_query_params(input_dict))
     except Exception as e:
-        print("Error executing database query '%s', aborting." % query)
+        print("Error executing database query '%s' with parameters %s, aborting." % (query, str(get_query_params(input_dict))))
         cur.close()
         conn.close()
         print(e)
         sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+    description = cur.description
+    if stream==True:
+        return QueryResults(stream_results(conn, cur, batch_size, report_empty), description)
     res = cur.fetchall()
     #Results length 0 isn't necessarily an error, but let the user know
-    if len(res)==0:
+    if len(res)==0 and report_empty==True:
         print("No entries found in the database which match all filters.\n")
     cur.close()
     conn.close()
     if (debug):
         end_time = timeit.default_timer()
         print("Database query took %f sec." % (end_time-start_time))
-    return res
+    return QueryResults(res, description)
 
-#If data product is seismograms, write a url file and calculate data size
-def write_url_file(args_dict, input_dict, config_dict, result_set):
-    print("Calculating disk space required for seismograms.")
-    seis_dict = dict()
-    temp_disk_space_mb = 0.0
-    track_file_size = True
-    #Attempt to query # of rupture variations using built-in SQLite DB
+#Opens a connection for running this request's queries, with the event table loaded if there is one
+def get_query_connection(config_dict, input_dict):
+    conn = db_connection.get_connection(config_dict)
+    if 'event_table' in input_dict:
+        load_event_table(conn, config_dict, input_dict['event_table'])
+    return conn
+
+#Estimates the number of rows the request will return.
+#method 'explain' multiplies out MySQL's EXPLAIN row estimates, which is cheap; 'count' runs a COUNT(*) probe, which is exact.
+#SQLite EXPLAIN doesn't estimate rows, so SQLite always uses 'count'.
+#conn is a connection from get_query_connection() to reuse, which is left open.
+def estimate_num_rows(config_dict, input_dict, method='explain', conn=None):
+    own_conn = (conn is None)
+    if own_conn:
+        conn = get_query_connection(config_dict, input_dict)
+    cur = db_connection.get_cursor(conn, config_dict)
     try:
-        num_rvs_db_path = '%s/../num_rvs.sqlite' % (os.path.dirname(os.path.abspath(__file__)))
-        if os.path.exists(num_rvs_db_path):
-            print("Using built-in database to determine data size.")
-            conn = sqlite3.connect(num_rvs_db_path)
+        if method=='explain' and config_dict['type'].lower()=='mysql':
+            execute_query(cur, config_dict, 'EXPLAIN %s' % get_query_string(input_dict, config_dict), get_query_params(input_dict))
+            num_rows = 1.0
+            for row in cur.fetchall():
+                filtered = row.get('filtered')
+                if filtered is None:
+                    filtered = 100.0
+                num_rows *= max(1, row['rows'] or 1)*float(filtered)/100.0
+            num_rows = int(num_rows)
         else:
-            print("Using config file DB to determine data size.")
-        #Open connection to query # of rupture variations
-        if config_dict['type'].lower()=='mysql':
-            conn = pymysql.connect(host=config_dict["host"], user=config_dict["user"], passwd=config_dict["password"], db=config_dict['db'])
-        elif config_dict['type'].lower()=='sqlite':
-            conn = sqlite3.connect(config_dict['db_path'])
-        cur = conn.cursor()
+            count_query = 'select count(*) as Num_Rows from (select %s from %s where %s) as Estimate_Rows' % (input_dict['select'], input_dict['from'], input_dict['where'])
+            execute_query(cur, config_dict, count_query, get_query_params(input_dict))
+            num_rows = int(cur.fetchone()['Num_Rows'])
     except Exception as e:
-        error_str = "Error connecting to database to determine data size.  Will continue without data size information."
-        print(error_str, file=sys.stderr)
+        print("Error estimating the size of the request, aborting.", file=sys.stderr)
         print(e)
-        track_file_size = False
+        cur.close()
+        conn.close()
+        sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+    cur.close()
+    if own_conn:
+        conn.close()
+    return num_rows
+
+#Fetches up to ESTIMATE_SAMPLE_ROWS rows, to measure how big each row is in each output format
+#The sort is left off, so the database can stop after the first rows
+def sample_rows(config_dict, input_dict, conn=None):
+    own_conn = (conn is None)
+    if own_conn:
+        conn = get_query_connection(config_dict, input_dict)
+    cur = db_connection.get_cursor(conn, config_dict)
+    execute_query(cur, config_dict, 'select %s from %s where %s limit %d' % (input_dict['select'], input_dict['from'], input_dict['where'], ESTIMATE_SAMPLE_ROWS), get_query_params(input_dict))
+    rows = cur.fetchall()
+    description = cur.description
+    cur.close()
+    if own_conn:
+        conn.close()
+    return QueryResults(rows, description)
+
+#Returns a dict of output format -> estimated bytes per row, measured from the sample rows
+def estimate_row_bytes(sample):
+    row_bytes = dict()
+    rows = sample.get_rows()
+    if len(rows)==0:
+        return row_bytes
+    #Write the sample as CSV in memory
+    csv_buffer = io.StringIO()
+    csv_writer = csv.writer(csv_buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+    csv_writer.writerows([tuple(row.values()) for row in rows])
+    csv_row_bytes = len(csv_buffer.getvalue().encode('utf-8'))/float(len(rows))
+    row_bytes['csv'] = csv_row_bytes
+    for output_format in csv_compression_dict:
+        row_bytes[output_format] = csv_row_bytes*CSV_COMPRESSION_RATIO_ESTIMATE
+    #SQLite stores values in about as many bytes as the CSV text, plus row and index overhead
+    row_bytes['sqlite'] = csv_row_bytes*SQLITE_OVERHEAD_ESTIMATE
+    dtypes = get_numpy_dtypes(sample.get_description(), get_column_types(sample.get_description(), rows[0]))
+    #String columns are stored as 4-byte codes
+    row_bytes['columnar'] = float(sum([4 if d==str else np.dtype(d).itemsize for d in dtypes]))
+    return row_bytes
+
+#Prints the estimated size of the request, without retrieving it.  Returns the estimated number of rows.
+def estimate_request(config_dict, input_dict, method='explain'):
+    print("Estimating the size of the %s request." % input_dict['data_product'])
+    start_time = timeit.default_timer()
+    #Both probes share one connection, so the event table is only loaded once
+    conn = get_query_connection(config_dict, input_dict)
+    num_rows = estimate_num_rows(config_dict, input_dict, method=method, conn=conn)
+    sample = sample_rows(config_dict, input_dict, conn=conn)
+    conn.close()
+    row_bytes = estimate_row_bytes(sample)
+    if method=='explain' and config_dict['type'].lower()=='mysql':
+        print("Estimated rows (from EXPLAIN): %d" % num_rows)
+    else:
+        print("Rows: %d" % num_rows)
+    for output_format in row_bytes:
+        print("Estimated %s output size: %.1f MB" % (output_format, num_rows*row_bytes[output_format]/1000000.0))
+    if input_dict['data_product']=="Seismograms" and len(sample.get_rows())>0:
+        rv_seis_size = utilities.get_rv_seismogram_size(sample.get_rows()[0]['Study_Name'])
+        print("Estimated output seismogram size: %.1f MB" % (num_rows*rv_seis_size/1000000.0))
+    print("Estimated fetch time: %.1f sec" % (num_rows/ESTIMATED_FETCH_ROWS_PER_SEC))
+    print("Estimate took %.1f sec." % (timeit.default_timer()-start_time))
+    if num_rows>MAX_QUERY_ROWS:
+        print("This request is larger than the maximum of %d rows, and will only run with --force." % MAX_QUERY_ROWS)
+    return num_rows
+
+#Before running a request against MySQL, checks its size, and refuses requests over MAX_QUERY_ROWS.
+#The EXPLAIN estimate is of rows examined, which for joins can be far more than the rows returned,
+#so a request is only refused once a COUNT(*) probe confirms it's too large.
+#conn is a connection from get_query_connection() to reuse, which is left open.
+def check_request_size(config_dict, input_dict, conn=None):
+    if config_dict['type'].lower()!='mysql':
+        return
+    num_rows = estimate_num_rows(config_dict, input_dict, method='explain', conn=conn)
+    if num_rows>MAX_QUERY_ROWS:
+        print("EXPLAIN estimates this request examines %d rows, more than the maximum of %d; counting the rows it returns." % (num_rows, MAX_QUERY_ROWS))
+        num_rows = estimate_num_rows(config_dict, input_dict, method='count', conn=conn)
+        if num_rows>MAX_QUERY_ROWS:
+            print("This request returns %d rows, more than the maximum of %d, and will not proceed." % (num_rows, MAX_QUERY_ROWS), file=sys.stderr)
+            print("Use --estimate to see the expected output size, add filters to narrow the request, or use --force to run it anyway.", file=sys.stderr)
+            sys.exit(utilities.ExitCodes.VALUE_OUT_OF_RANGE)
+    if num_rows>WARN_QUERY_ROWS:
+        print("Warning: this request is estimated to return %d rows." % num_rows)
+
+#Returns the column which the request will be split on for this partition key, or None if the request doesn't include it
+def get_partition_column(input_dict, partition_key):
+    from_tables = [t.strip() for t in input_dict['from'].split(",")]
+    for (table, field) in partition_columns[partition_key]:
+        if table in from_tables:
+            return "%s.%s" % (table, field)
+    return None
+
+#Returns a list of where clauses, one per partition, which split the request into disjoint pieces
+def get_partition_clauses(config_dict, input_dict, partition_key, num_partitions):
+    partition_column = get_partition_column(input_dict, partition_key)
+    if partition_column is None:
+        print("This request can't be partitioned by %s, since it doesn't use any of the tables %s, aborting." % (partition_key, ", ".join([t for (t, f) in partition_columns[partition_key]])), file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    #With distinct, the same row could come from two partitions unless the partition column is selected
+    if input_dict['select'].strip().lower().startswith("distinct") and partition_column.split(".")[1] not in get_columns(input_dict):
+        print("This request selects distinct rows, so it can't be partitioned by %s, aborting." % partition_key, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    conn = db_connection.get_connection(config_dict)
+    cur = db_connection.get_cursor(conn, config_dict)
+    clauses = []
+    if partition_key=='source':
+        #Split the range of source IDs evenly
+        cur.execute('select min(Source_ID) as Min_ID, max(Source_ID) as Max_ID from Ruptures')
+        row = cur.fetchone()
+        (min_id, max_id) = (row['Min_ID'], row['Max_ID'])
+        step = (max_id-min_id)//num_partitions + 1
+        for start in range(min_id, max_id+1, step):
+            clauses.append("%s between %d and %d" % (partition_column, start, start+step-1))
+    else:
+        #Deal the IDs out round-robin from the small lookup table
+        (table, field) = partition_columns[partition_key][-1]
+        cur.execute('select %s.%s as ID from %s order by %s.%s' % (table, field, table, table, field))
+        ids = [row['ID'] for row in cur.fetchall()]
+        for i in range(0, min(num_partitions, len(ids))):
+            clauses.append("%s in (%s)" % (partition_column, ",".join([str(id) for id in ids[i::num_partitions]])))
+    cur.close()
+    conn.close()
+    return clauses
+
+#Puts item on out_queue, unless stop_event is set while it waits for room.  Returns False if it was stopped.
+def put_partition_message(out_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=PARTITION_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+#Runs one partition's query, putting its description and then batches of rows on out_queue, followed by a 'done' message.
+#Once stop_event is set, the partition stops and closes its query.
+#Empty partitions aren't reported, since the merged results may still have rows
+def run_partition(config_dict, input_dict, batch_size, index, out_queue, stop_event):
+    result_iter = None
+    try:
+        result_set = execute_queries(config_dict, input_dict, stream=True, batch_size=batch_size, report_empty=False)
+        result_iter = iter(result_set)
+        if not put_partition_message(out_queue, (index, 'description', result_set.get_description()), stop_event):
+            return
+        while True:
+            batch = list(itertools.islice(result_iter, batch_size))
+            if len(batch)==0:
+                break
+            if not put_partition_message(out_queue, (index, 'rows', batch), stop_event):
+                return
+        put_partition_message(out_queue, (index, 'done', None), stop_event)
+    except BaseException as e:
+        #Includes SystemExit from the error handling in execute_queries()
+        put_partition_message(out_queue, (index, 'error', e), stop_event)
+    finally:
+        #Closes the cursor and connection if the query was stopped partway through
+        if result_iter is not None:
+            result_iter.close()
+
+#Returns the description from the first message on in_queue, which is a partition's description unless it failed
+def read_partition_description(in_queue):
+    (index, kind, value) = in_queue.get()
+    if kind=='error':
+        raise value
+    return value
+
+#Yields the rows for one partition from its queue, after its description
+def read_partition_queue(in_queue):
+    while True:
+        (index, kind, value) = in_queue.get()
+        if kind=='done':
+            return
+        elif kind=='error':
+            raise value
+        elif kind=='rows':
+            for row in value:
+                yield row
+
+#Yields the rows from all partitions in whatever order they arrive.  The partitions' descriptions are all the same, so they're skipped.
+def read_shared_queue(in_queue, num_partitions):
+    num_done = 0
+    while num_done<num_partitions:
+        (index, kind, value) = in_queue.get()
+        if kind=='done':
+            num_done += 1
+        elif kind=='error':
+            raise value
+        elif kind=='rows':
+            for row in value:
+                yield row
+
+#Returns a key function which orders rows on sort_field the way the database sorted each partition:
+#NULLs before everything else, and on MySQL, strings compared without regard to case, as its default collations do
+def get_merge_key(config_dict, sort_field):
+    fold_case = (config_dict['type'].lower()=='mysql')
+    def merge_key(row):
+        value = row[sort_field]
+        if value is None:
+            return (0, 0)
+        if fold_case and isinstance(value, str):
+            return (1, value.casefold())
+        return (1, value)
+    return merge_key
+
+#Splits the request into num_partitions pieces along partition_key ('site', 'im_type', or 'source'),
+#runs them concurrently on separate connections, and merges the results, preserving any sort order.
+#The partitions are stopped if the results aren't read to the end.
+def execute_partitioned_queries(config_dict, input_dict, partition_key, num_partitions, batch_size=STREAM_BATCH_SIZE):
+    start_time = timeit.default_timer()
+    num_partitions = max(1, min(num_partitions, MAX_PARALLEL_QUERIES))
+    sorted_results = ('sort' in input_dict)
+    if sorted_results:
+        (sort_field, sort_order) = input_dict['sort'].split()[-2:]
+        sort_field = sort_field.split(".")[-1]
+        #The merge compares the rows on the sort column, so it has to come back under its own name
+        if sort_field not in get_columns(input_dict):
+            print("This request is sorted on %s, which it doesn't select under that name, so it can't be partitioned, aborting." % sort_field, file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+    clauses = get_partition_clauses(config_dict, input_dict, partition_key, num_partitions)
+    print("Running query as %d partitions by %s." % (len(clauses), partition_key))
+    #Bounded queues, so fast partitions can't get too far ahead of the merge
+    if sorted_results:
+        queues = [queue.Queue(maxsize=PARTITION_QUEUE_BATCHES) for c in clauses]
+    else:
+        shared_queue = queue.Queue(maxsize=PARTITION_QUEUE_BATCHES*len(clauses))
+        queues = [shared_queue for c in clauses]
+    stop_event = threading.Event()
+    for (i, clause) in enumerate(clauses):
+        partition_dict = dict(input_dict)
+        partition_dict['where'] = "(%s) and %s" % (input_dict['where'], clause)
+        worker = threading.Thread(target=run_partition, args=(config_dict, partition_dict, batch_size, i, queues[i], stop_event), daemon=True)
+        worker.start()
+    try:
+        #Every partition sends the same description first, so the first to arrive will do
+        description = read_partition_description(queues[0])
+    except BaseException:
+        stop_event.set()
+        raise
+    if sorted_results:
+        #Merge the sorted partitions
+        rows = heapq.merge(*[read_partition_queue(q) for q in queues], key=get_merge_key(config_dict, sort_field), reverse=(sort_order.lower()=='desc'))
+    else:
+        rows = read_shared_queue(shared_queue, len(clauses))
+    return QueryResults(report_partitioned_results(rows, start_time, stop_event), description)
+
+#Passes the merged rows through, and stops the partitions when they've been read, or reading them stopped early
+def report_partitioned_results(rows, start_time, stop_event):
+    num_rows = 0
+    try:
+        for row in rows:
+            num_rows += 1
+            yield row
+    finally:
+        stop_event.set()
+    if num_rows==0:
+        print("No entries found in the database which match all filters.\n")
+    if (debug):
+        print("Partitioned query took %f sec." % (timeit.default_timer()-start_time))
+
+#Like execute_queries(), but returns results from the on-disk query cache if this query has been run before.
+#If refresh is True, the query is always run and the cached results are replaced.
+#If partition_key is given, the query is run with execute_partitioned_queries().
+#conn is a connection from get_query_connection() for execute_queries() to reuse; it's closed if it isn't needed.
+def execute_cached_queries(config_dict, input_dict, stream=False, batch_size=STREAM_BATCH_SIZE, cache_dir=None, refresh=False, partition_key=None, num_partitions=1, conn=None):
+    cache = query_cache.QueryCache(cache_dir)
+    if refresh==False:
+        cached = cache.get(config_dict, input_dict)
+        if cached is not None:
+            if conn is not None:
+                conn.close()
+            (description, rows) = cached
+            if stream==False:
+                rows = list(rows)
+            return QueryResults(rows, description)
+    if partition_key is not None:
+        if conn is not None:
+            conn.close()
+        result_set = execute_partitioned_queries(config_dict, input_dict, partition_key, num_partitions, batch_size=batch_size)
+    else:
+        result_set = execute_queries(config_dict, input_dict, stream=stream, batch_size=batch_size, conn=conn)
+    rows = cache.store(config_dict, input_dict, result_set.get_description(), result_set.get_rows())
+    if stream==False:
+        rows = list(rows)
+    return QueryResults(rows, result_set.get_description())
+
+#Rows of an executed query, along with the column descriptions from the cursor.
+#rows is either a list, or a generator from stream_results() which can only be iterated once.
+class QueryResults:
+
+    def __init__(self, rows, description):
+        self.rows = rows
+        self.description = description
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def get_rows(self):
+        return self.rows
+
+    def get_description(self):
+        return self.description
+
+#Yields the rows of an executed query, fetching batch_size rows at a time so memory use doesn't grow with the result set
+def stream_results(conn, cur, batch_size=STREAM_BATCH_SIZE, report_empty=True):
+    num_rows = 0
+    try:
+        while True:
+            #Errors here are the database's, not the output file's, which the caller is writing to
+            try:
+                rows = cur.fetchmany(batch_size)
+            except (pymysql.Error, sqlite3.Error) as e:
+                print("Error fetching results from the database, aborting.", file=sys.stderr)
+                print(e)
+                sys.exit(utilities.ExitCodes.DATABASE_COMMAND_ERROR)
+            if len(rows)==0:
+                break
+            num_rows += len(rows)
+            for row in rows:
+                yield row
+    finally:
+        cur.close()
+        conn.close()
+    #Results length 0 isn't necessarily an error, but let the user know
+    if num_rows==0 and report_empty==True:
+        print("No entries found in the database which match all filters.\n")
+
+#Passes rows through, recording the seismogram URL and rupture variation for each one in seis_dict
+def collect_seismogram_urls(result_set, seis_dict):
     for row in result_set:
         study_name = row['Study_Name']
-        if study_name not in globus_dict:
+        if study_name not in utilities.globus_dict:
             print("Not sure where to download seismograms from for study %s, aborting." % study_name, file=sys.stderr)
             sys.exit(utilities.ExitCodes.DATABASE_CONNECTION_ERROR)
-        study_prefix = globus_dict[study_name]
+        study_prefix = utilities.globus_dict[study_name]
         study_suffix = ".grm"
-        rv_seis_size = utilities.get_rv_seismogram_size(study_name)
         #Add the '_bb' to seismogram filenames for broadband studies
-        if study_name in suffix_dict:
-            study_suffix = "%s%s" % (suffix_dict[study_name], study_suffix)
+        if study_name in utilities.suffix_dict:
+            study_suffix = "%s%s" % (utilities.suffix_dict[study_name], study_suffix)
         #Need site name, run ID, source_ID, rupture_ID, rup_var_ID
         site_name = row['CS_Short_Name']
         run_id = row['Run_ID']
@@ -177,27 +705,91 @@ def write_url_file(args_dict, input_dict, config_dict, result_set):
         rup_var_id = row['Rup_Var_ID']
         full_url = '%s/%s/%d/Seismogram_%s_%d_%d%s' % (study_prefix, site_name, run_id, site_name, source_id, rupture_id, study_suffix)
         if full_url in seis_dict:
-            seis_dict[full_url] = "%s,%d" % (seis_dict[full_url], rup_var_id)
+            seis_dict[full_url][4].append(rup_var_id)
         else:
-            seis_dict[full_url] = "%d" % (rup_var_id)
-            #Figure out size
-            if track_file_size==True:
-                num_rvs_query = 'select Studies.Study_Name, count(*) from Rupture_Variations, CyberShake_Runs, Studies ' \
-                    'where Studies.Study_ID=CyberShake_Runs.Study_ID and CyberShake_Runs.Run_ID=%d and CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID and CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID and Rupture_Variations.Source_ID=%d and Rupture_Variations.Rupture_ID=%d' \
-                    % (run_id, source_id, rupture_id)
-                cur.execute(num_rvs_query)
-                (study_name, num_rvs) = cur.fetchone()
-                temp_disk_space_mb += num_rvs*rv_seis_size/(1000000.0)
-    if track_file_size==True and len(result_set)>0:
-        conn.close()
-        output_disk_space_mb = rv_seis_size*len(result_set)/(1000000.0)
+            seis_dict[full_url] = [study_name, run_id, source_id, rupture_id, [rup_var_id]]
+        yield row
+
+#Returns a dict of URL -> # of rupture variations in that rupture file, for the URLs in seis_dict
+#Uses the in-memory index of the built-in SQLite DB where possible, and the config file DB for any ruptures it doesn't know about
+def get_num_rvs(config_dict, seis_dict):
+    num_rvs_dict = dict()
+    rv_index = rv_counts.get_rv_count_index()
+    #Group the URLs by study, so each study's counts are looked up in one vectorized call
+    study_urls = dict()
+    for full_url in seis_dict:
+        study_name = seis_dict[full_url][0]
+        if study_name not in study_urls:
+            study_urls[study_name] = []
+        study_urls[study_name].append(full_url)
+    for study_name in study_urls:
+        if not rv_index.has_study(study_name):
+            continue
+        urls = study_urls[study_name]
+        source_ids = [seis_dict[full_url][2] for full_url in urls]
+        rupture_ids = [seis_dict[full_url][3] for full_url in urls]
+        num_rvs = rv_index.num_rvs_bulk(study_name, source_ids, rupture_ids)
+        for (full_url, n) in zip(urls, num_rvs.tolist()):
+            if n!=rv_counts.UNKNOWN_NUM_RVS:
+                num_rvs_dict[full_url] = n
+    if len(num_rvs_dict)>0:
+        print("Using built-in database to determine data size.")
+    missing_urls = [full_url for full_url in seis_dict if full_url not in num_rvs_dict]
+    if len(missing_urls)==0:
+        return num_rvs_dict
+    print("Using config file DB to determine data size.")
+    #Count the rupture variations for many ruptures in each query, grouped by run and rupture
+    url_lookup = dict()
+    for full_url in missing_urls:
+        (study_name, run_id, source_id, rupture_id, rv_list) = seis_dict[full_url]
+        url_lookup[(run_id, source_id, rupture_id)] = full_url
+    keys = list(url_lookup.keys())
+    conn = db_connection.get_connection(config_dict)
+    cur = db_connection.get_cursor(conn, config_dict)
+    for i in range(0, len(keys), NUM_RVS_CHUNK_SIZE):
+        chunk = keys[i:i+NUM_RVS_CHUNK_SIZE]
+        num_rvs_query = 'select CyberShake_Runs.Run_ID as Run_ID, Rupture_Variations.Source_ID as Source_ID, Rupture_Variations.Rupture_ID as Rupture_ID, count(*) as Num_Rup_Vars ' \
+            'from Rupture_Variations, CyberShake_Runs ' \
+            'where CyberShake_Runs.ERF_ID=Rupture_Variations.ERF_ID and CyberShake_Runs.Rup_Var_Scenario_ID=Rupture_Variations.Rup_Var_Scenario_ID ' \
+            'and (CyberShake_Runs.Run_ID, Rupture_Variations.Source_ID, Rupture_Variations.Rupture_ID) in (%s) ' \
+            'group by CyberShake_Runs.Run_ID, Rupture_Variations.Source_ID, Rupture_Variations.Rupture_ID' \
+            % (",".join(["(%d,%d,%d)" % k for k in chunk]))
+        cur.execute(num_rvs_query)
+        for row in cur.fetchall():
+            num_rvs_dict[url_lookup[(row['Run_ID'], row['Source_ID'], row['Rupture_ID'])]] = row['Num_Rup_Vars']
+    cur.close()
+    conn.close()
+    return num_rvs_dict
+
+#If data product is seismograms, write a url file and calculate data size
+#seis_dict is populated by collect_seismogram_urls() as the results are written
+def write_url_file(args_dict, input_dict, config_dict, seis_dict):
+    print("Calculating disk space required for seismograms.")
+    temp_disk_space_mb = 0.0
+    output_disk_space_mb = 0.0
+    track_file_size = True
+    try:
+        num_rvs_dict = get_num_rvs(config_dict, seis_dict)
+    except Exception as e:
+        error_str = "Error querying database to determine data size.  Will continue without data size information."
+        print(error_str, file=sys.stderr)
+        print(e)
+        track_file_size = False
+    #Estimated size of each rupture file, passed to the data collector for sizing its download batches
+    file_sizes = dict()
+    for full_url in seis_dict:
+        (study_name, run_id, source_id, rupture_id, rv_list) = seis_dict[full_url]
+        rv_seis_size = utilities.get_rv_seismogram_size(study_name)
+        output_disk_space_mb += rv_seis_size*len(rv_list)/(1000000.0)
+        if track_file_size==True:
+            file_sizes[full_url] = num_rvs_dict.get(full_url, len(rv_list))*rv_seis_size
+            temp_disk_space_mb += file_sizes[full_url]/(1000000.0)
+    if track_file_size==True and len(seis_dict)>0:
         print("Temporary disk space required to download seismograms: %.1f MB" % (temp_disk_space_mb))
         print("Disk space required for requested output seismograms: %.1f MB" % (output_disk_space_mb))
         if temp_disk_space_mb>MAX_TEMP_DATA_MB:
-            print("Your requested seismogram download requires more temporary space than the maximum permitted space of %d MB and will not proceed." % MAX_TEMP_DATA_MB)
-            print("Either increase MAX_TEMP_DATA_MB in run_database_wrapper.py or request fewer seismograms.")
-            #Don't write out a URL file
-            return
+            #The collector downloads, extracts and deletes in batches, so this only limits the temp space in use at once
+            print("This is more than %d MB of temporary space, so the seismograms will be downloaded and extracted in batches of at most %d MB." % (MAX_TEMP_DATA_MB, MAX_TEMP_DATA_MB))
         if output_disk_space_mb>MAX_OUTPUT_DATA_MB:
             print("Your requested seismogram download requires more disk space than the maximum permitted space of %d MB and will not proceed." % MAX_OUTPUT_DATA_MB)
             print("Either increase MAX_OUTPUT_DATA_MB in run_database_wrapper.py or request fewer seismograms.")
@@ -206,82 +798,211 @@ def write_url_file(args_dict, input_dict, config_dict, result_set):
     url_filename = "%s.urls" % args_dict['output_filename'].rsplit(".", 1)[0]
     with open(url_filename, 'w') as fp_out:
         for key in seis_dict:
-            fp_out.write("%s %s\n" % (key, seis_dict[key]))
+            if key in file_sizes:
+                fp_out.write("%s %s %d\n" % (key, ",".join([str(rv) for rv in seis_dict[key][4]]), file_sizes[key]))
+            else:
+                fp_out.write("%s %s\n" % (key, ",".join([str(rv) for rv in seis_dict[key][4]])))
         fp_out.flush()
-        fp_out.close()         
+        fp_out.close()
 
-def write_results(result_set, args_dict, input_dict, config_dict):
+#Returns the bare field names of the selected columns, in select order
+def get_columns(input_dict):
+    columns = []
+    for c in input_dict['select'].split(","):
+        columns.append(c.split(".")[1].strip())
+    return columns
+
+#Opens a text file for CSV output with a large write buffer, compressed if compression is 'gzip' or 'zstd'
+def open_csv_file(filename, compression=None):
+    if compression is None:
+        return open(filename, 'w', newline='', buffering=CSV_BUFFER_SIZE)
+    elif compression=='gzip':
+        raw_out = gzip.GzipFile(filename, 'wb', compresslevel=GZIP_COMPRESSION_LEVEL)
+        return io.TextIOWrapper(io.BufferedWriter(raw_out, buffer_size=CSV_BUFFER_SIZE), newline='')
+    elif compression=='zstd':
+        if zstandard is None:
+            print("zstd compression requires the zstandard package (pip install zstandard), aborting.", file=sys.stderr)
+            sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+        cctx = zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL, threads=-1)
+        return zstandard.open(filename, 'wt', cctx=cctx, newline='')
+    else:
+        print("Compression type '%s' is unrecognized, aborting." % compression, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
+
+#Writes the rows to a CSV file, returns the number of rows written
+#Stands in for NULLs in CSV output.  The csv module writes numeric values unquoted using str(), so NULLs are written as None, as they always have been, rather than as "".
+class CSVNull:
+    def __float__(self):
+        return float('nan')
+
+    def __str__(self):
+        return "None"
+
+CSV_NULL = CSVNull()
+
+#Returns the row's values for the CSV writer
+def get_csv_values(row):
+    values = tuple(row.values())
+    if None in values:
+        return tuple(CSV_NULL if v is None else v for v in values)
+    return values
+
+def write_csv(result_set, filename, columns, compression=None):
+    num_rows = 0
+    with open_csv_file(filename, compression) as fp_out:
+        #Write headers
+        columns_pretty = []
+        for c in columns:
+            columns_pretty.append(utilities.get_field_alias(c))
+        fp_out.write("%s\n" % ",".join(columns_pretty))
+        #Write data, quoting any string datatypes
+        csv_writer = csv.writer(fp_out, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        result_iter = iter(result_set)
+        while True:
+            #row.values() because we're using a DictCursor
+            batch = [get_csv_values(row) for row in itertools.islice(result_iter, CSV_BATCH_SIZE)]
+            if len(batch)==0:
+                break
+            csv_writer.writerows(batch)
+            num_rows += len(batch)
+        fp_out.flush()
+    return num_rows
+
+#Returns the Python type name ('int', 'float', or 'str') of each result column.
+#Uses the MySQL type codes from the cursor description; SQLite doesn't report types, so those come from first_row.
+def get_column_types(description, first_row):
+    column_types = []
+    first_values = []
+    if first_row is not None:
+        first_values = list(first_row.values())
+    for i, d in enumerate(description):
+        type_code = d[1]
+        if type_code in mysql_int_types:
+            column_types.append('int')
+        elif type_code in mysql_float_types:
+            column_types.append('float')
+        elif type_code is None and i<len(first_values) and type(first_values[i]).__name__ in ['int', 'float']:
+            column_types.append(type(first_values[i]).__name__)
+        else:
+            column_types.append('str')
+    return column_types
+
+#Writes the rows to a SQLite file, returns the number of rows written
+def write_sqlite(result_set, filename, columns):
     #Mapping of Python types to SQLite types
     sqlite_type_dict = dict()
     sqlite_type_dict['str'] = 'TEXT'
     sqlite_type_dict['int'] = 'INTEGER'
     sqlite_type_dict['float'] = 'REAL'
+    num_rows = 0
+    conn = sqlite3.connect(filename)
+    cur = conn.cursor()
+    #We're writing a new file from scratch, so trade durability for load speed
+    cur.execute('PRAGMA journal_mode=OFF')
+    cur.execute('PRAGMA synchronous=OFF')
+    cur.execute('PRAGMA locking_mode=EXCLUSIVE')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute('PRAGMA cache_size=-%d' % SQLITE_CACHE_SIZE_KB)
+    #Create schema
+    #SQLite config DBs don't give column types, so peek at the first row in case we need it
+    result_iter = iter(result_set)
+    first_row = next(result_iter, None)
+    if first_row is not None:
+        result_iter = itertools.chain([first_row], result_iter)
+    column_types = get_column_types(result_set.get_description(), first_row)
+    create_columns = []
+    for (c, t) in zip(columns, column_types):
+        create_columns.append("%s %s" % (c, sqlite_type_dict[t]))
+    cur.execute('DROP TABLE IF EXISTS CyberShake_Data')
+    cur.execute('CREATE TABLE CyberShake_Data (%s)' % (', '.join(create_columns)))
+    #Insert in large batches, all in one transaction
+    insert_cmd = 'INSERT INTO CyberShake_Data VALUES (%s)' % (','.join(['?']*len(columns)))
+    cur.execute('BEGIN')
+    while True:
+        batch = [tuple(row.values()) for row in itertools.islice(result_iter, SQLITE_INSERT_BATCH_SIZE)]
+        if len(batch)==0:
+            break
+        cur.executemany(insert_cmd, batch)
+        num_rows += len(batch)
+    #Build the indices after loading, which is much faster than maintaining them during the inserts
+    index_columns = [c for c in ['Source_ID', 'Rupture_ID', 'Rup_Var_ID'] if c in columns]
+    if len(index_columns)>0:
+        cur.execute('CREATE INDEX CyberShake_Data_Event_Index ON CyberShake_Data (%s)' % (', '.join(index_columns)))
+    if 'CS_Short_Name' in columns:
+        cur.execute('CREATE INDEX CyberShake_Data_Site_Index ON CyberShake_Data (CS_Short_Name)')
+    conn.commit()
+    conn.close()
+    return num_rows
+
+#Returns the numpy dtype for each column of columnar output, or str for string columns
+def get_numpy_dtypes(description, column_types):
+    dtypes = []
+    for (d, t) in zip(description, column_types):
+        if t=='str':
+            dtypes.append(str)
+        elif d[1]==FIELD_TYPE.FLOAT:
+            dtypes.append(np.float32)
+        elif d[1] in [FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.INT24, FIELD_TYPE.YEAR]:
+            dtypes.append(np.int32)
+        elif t=='int':
+            dtypes.append(np.int64)
+        else:
+            dtypes.append(np.float64)
+    return dtypes
+
+#Writes the rows to a directory of per-column .npy files, returns the number of rows written
+def write_columnar(result_set, filename, columns):
+    num_rows = 0
+    result_iter = iter(result_set)
+    first_row = next(result_iter, None)
+    if first_row is not None:
+        result_iter = itertools.chain([first_row], result_iter)
+    description = result_set.get_description()
+    dtypes = get_numpy_dtypes(description, get_column_types(description, first_row))
+    writer = columnar_output.ColumnarWriter(filename, columns, dtypes)
+    while True:
+        batch = [tuple(row.values()) for row in itertools.islice(result_iter, COLUMNAR_BATCH_SIZE)]
+        if len(batch)==0:
+            break
+        writer.write_rows(batch)
+        num_rows += len(batch)
+    writer.close()
+    return num_rows
+
+#result_set is the QueryResults from execute_queries(); it is only iterated once, so it can be streamed
+def write_results(result_set, args_dict, input_dict, config_dict):
+    start_time = timeit.default_timer()
+    #If we're doing seismograms, collect the URLs as the rows go by
+    seis_dict = None
+    if input_dict['data_product']=="Seismograms":
+        seis_dict = dict()
+        result_set = QueryResults(collect_seismogram_urls(result_set, seis_dict), result_set.get_description())
+    columns = get_columns(input_dict)
     #Write data and metadata to output file
     try:
         if args_dict['output_format'].lower()=='csv':
             filename = args_dict['output_filename']
             if filename[-3:]!='csv':
                 filename = "%s.csv" % (filename)
-            with open(filename, 'w') as fp_out:
-                #Write headers
-                columns = input_dict['select'].split(",")
-                columns_pretty = []
-                for c in columns:
-                    columns_pretty.append(utilities.get_field_alias(c.split(".")[1]))
-                fp_out.write("%s\n" % ",".join(columns_pretty))
-                #Write data
-                for row in result_set:
-                    #Quote any string datatypes
-                    line_strs = []
-                    #row.values() because we're using a DictCursor
-                    for r in row.values():
-                        if type(r)==str:
-                            line_strs.append('"%s"' % r)
-                        else:
-                            line_strs.append(str(r))
-                    fp_out.write("%s\n" % ",".join(line_strs))
-                fp_out.flush()
-                fp_out.close()
+            num_rows = write_csv(result_set, filename, columns)
+        elif args_dict['output_format'].lower() in csv_compression_dict:
+            output_format = args_dict['output_format'].lower()
+            filename = args_dict['output_filename']
+            if not filename.endswith(output_format):
+                filename = "%s.%s" % (filename, output_format)
+            num_rows = write_csv(result_set, filename, columns, compression=csv_compression_dict[output_format])
         elif args_dict['output_format'].lower()=='sqlite':
             print("Using sqlite format.")
             filename = args_dict['output_filename']
             if filename[-6:]!='sqlite':
                 filename = "%s.sqlite" % (filename)
-            conn = sqlite3.connect(filename)
-            cur = conn.cursor()
-            #Create schema
-            create_table_cmd = 'CREATE TABLE CyberShake_Data'
-            #Figure out datatype from first row of results
-            #If results is empty, just make everything TEXT
-            if len(result_set)>0:
-                row_vals = []
-                for r in result_set[1].values():
-                    row_vals.append(r)
-            create_columns = []
-            columns = input_dict['select'].split(",")
-            for i, c in enumerate(columns):
-                column_type = type(row_vals[i]).__name__
-                if column_type in sqlite_type_dict:
-                    sqlite_type = sqlite_type_dict[column_type]
-                else:
-                    sqlite_type = 'TEXT'
-                create_columns.append("%s %s" % (c.split('.')[1], sqlite_type))
-            create_table_cmd = "%s (%s)" % (create_table_cmd, ', '.join(create_columns))
-            cur.execute(create_table_cmd)
-            for row in result_set:
-                #Quote any string datatypes
-                line_strs = []
-                #row.values() because we're using a DictCursor
-                for r in row.values():
-                    if type(r)==str:
-                        line_strs.append('"%s"' % r)
-                    else:
-                        line_strs.append(str(r))
-                value_string = ", ".join(line_strs)
-                insert_cmd = 'insert into CyberShake_Data values (%s)' % value_string
-                cur.execute(insert_cmd)
-            conn.commit()
-            conn.close()
+            num_rows = write_sqlite(result_set, filename, columns)
+        elif args_dict['output_format'].lower()=='columnar':
+            print("Using columnar format.")
+            filename = args_dict['output_filename']
+            if filename[-7:]!='columns':
+                filename = "%s.columns" % (filename)
+            num_rows = write_columnar(result_set, filename, columns)
         else:
             print("Output format '%s' is unrecognized, aborting." % args_dict['output_format'], file=sys.stderr)
             sys.exit(utilities.ExitCodes.INVALID_ARGUMENTS)
@@ -289,9 +1010,11 @@ def write_results(result_set, args_dict, input_dict, config_dict):
         print("Error writing data to output file %s, aborting." % (args_dict['output_filename']), file=sys.stderr)
         print(e)
         sys.exit(utilities.ExitCodes.FILE_WRITING_ERROR)
+    end_time = timeit.default_timer()
+    print("Wrote %d rows in %.1f sec." % (num_rows, end_time-start_time))
     #If we're doing seismograms, need to create URL file
-    if input_dict['data_product']=="Seismograms":
-        write_url_file(args_dict, input_dict, config_dict, result_set)
+    if seis_dict is not None:
+        write_url_file(args_dict, input_dict, config_dict, seis_dict)
     print("\n=======================================================================================================")
     print("\nDatabase results are available in %s." % filename)
     print("\n=======================================================================================================")
@@ -302,7 +1025,27 @@ def run_main(argv):
     args_dict = parse_args(argv)
     config_dict = utilities.read_config(args_dict['config_filename'])
     input_dict = read_input(args_dict['input_filename'])
-    result_set = execute_queries(config_dict, input_dict)
+    if args_dict['compare_plans']==True:
+        compare_plans(config_dict, input_dict, batch_size=args_dict['batch_size'])
+        return
+    if args_dict['use_hints']==False:
+        input_dict = remove_join_plan(input_dict)
+    if args_dict['estimate'] is not None:
+        estimate_request(config_dict, input_dict, method=args_dict['estimate'])
+        return
+    #The size check's connection, with the event table already loaded, is reused for the query
+    conn = None
+    if args_dict['force']==False and config_dict['type'].lower()=='mysql' and not (args_dict['use_cache']==True and args_dict['refresh_cache']==False and query_cache.QueryCache(args_dict['cache_dir']).contains(config_dict, input_dict)):
+        conn = get_query_connection(config_dict, input_dict)
+        check_request_size(config_dict, input_dict, conn=conn)
+    if args_dict['use_cache']==True:
+        result_set = execute_cached_queries(config_dict, input_dict, stream=args_dict['stream'], batch_size=args_dict['batch_size'], cache_dir=args_dict['cache_dir'], refresh=args_dict['refresh_cache'], partition_key=args_dict['partition_key'], num_partitions=args_dict['num_partitions'], conn=conn)
+    elif args_dict['partition_key'] is not None:
+        if conn is not None:
+            conn.close()
+        result_set = execute_partitioned_queries(config_dict, input_dict, args_dict['partition_key'], args_dict['num_partitions'], batch_size=args_dict['batch_size'])
+    else:
+        result_set = execute_queries(config_dict, input_dict, stream=args_dict['stream'], batch_size=args_dict['batch_size'], conn=conn)
     write_results(result_set, args_dict, input_dict, config_dict)
 
 if __name__=="__main__":
@@ -9,6 +9,8 @@ import datetime
 
 
 import query_constructor
+import dimension_lookup
+import table_stats
 import utilities
 import filters
 import data_products
@@ -22,6 +24,9 @@ def parse_args(argv):
     parser = argparse.ArgumentParser(prog='Query Builder', description='Takes CyberShake data request and constructs database queries required to fulfill it.')
     parser.add_argument('-i', '--input-filename', dest='input_filename', action='store', default=None, help="Path to JSON file describing the data request.")
     parser.add_argument('-o', '--output-filename', dest='output_filename', action='store', default=None, help="Path to output file containing queries.")
+    parser.add_argument('-c', '--config-filename', dest='config_filename', action='store', default=None, help="Path to database configuration file.  If given, study, site and IM names are resolved to database IDs, so the queries need fewer joins.")
+    parser.add_argument('--refresh-ids', dest='refresh_ids', action='store_true', default=False, help="Re-read the study, site and IM IDs from the database instead of using the saved copy.")
+    parser.add_argument('--refresh-stats', dest='refresh_stats', action='store_true', default=False, help="Re-gather the table statistics used to plan the join order instead of using the saved copy.")
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', default=False, help='Turn on debug statements.')
     parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help="Show version number and exit.")
     args = parser.parse_args(args=argv)
@@ -37,7 +42,7 @@ def parse_args(argv):
         output_filename = "csdata.%02d%02d%02d_%02d%02d%04d.query" % (dt_tuple.tm_hour, dt_tuple.tm_min, dt_tuple.tm_sec, dt_tuple.tm_mon, dt_tuple.tm_mday, dt_tuple.tm_year)
     else:
         output_filename = args.output_filename
-    return (input_filename, output_filename)
+    return (input_filename, output_filename, args.config_filename, args.refresh_ids, args.refresh_stats)
 	
 def load_data():
     global model_list, dp_list, filter_list
@@ -115,6 +120,16 @@ def parse_json(input_filename):
           sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
     return (model_selected, dp_selected, filters_selected, event_list)
 
+#Writes the events for the event table to a CSV file next to the query file, returns its path
+def write_event_table(event_list, output_filename):
+    event_filename = "%s.events" % os.path.abspath(output_filename).rsplit(".", 1)[0]
+    with open(event_filename, 'w') as fp_out:
+        for e in event_list:
+            fp_out.write("%d,%d,%d\n" % (e[0], e[1], e[2]))
+        fp_out.flush()
+        fp_out.close()
+    return event_filename
+
 def write_queries(query, input_filename, output_filename, dp_name):
     with open(output_filename, 'w') as fp_out:
         distinct_string = ""
@@ -123,18 +138,39 @@ def write_queries(query, input_filename, output_filename, dp_name):
         fp_out.write("select = %s %s\n" % (distinct_string, query.get_select_string()))
         fp_out.write("from = %s\n" % query.get_from_string())
         fp_out.write("where = %s\n" % query.get_where_string())
+        #Values for the %s placeholders in the where clause, as a JSON list
+        fp_out.write("params = %s\n" % json.dumps(list(query.get_where_params())))
         if (query.get_sort()!=""):
             fp_out.write("sort = %s\n" % query.get_sort())
+        if query.get_join_order() is not None:
+            #Only used on MySQL
+            fp_out.write("join_order = %s\n" % ",".join(query.get_join_order()))
+            fp_out.write("index_hints = %s\n" % json.dumps(query.get_index_hints(), sort_keys=True))
+        if query.get_event_table() is not None:
+            fp_out.write("event_table = %s\n" % write_event_table(query.get_event_table(), output_filename))
+        if query.get_fingerprint() is not None:
+            #Identical requests have the same fingerprint
+            fp_out.write("request_fingerprint = %s\n" % query_constructor.get_fingerprint_digest(query.get_fingerprint()))
         fp_out.write("data_request_file = %s\n" % input_filename)
         fp_out.write("data_product = %s\n" % dp_name)
         fp_out.flush()
         fp_out.close()
 
 def run_main(argv):
-    (input_filename, output_filename) = parse_args(argv)
+    (input_filename, output_filename, config_filename, refresh_ids, refresh_stats) = parse_args(argv)
     load_data()
     (model_selected, dp_selected, filters_selected, event_list) = parse_json(input_filename)
-    query = query_constructor.construct_queries(model_selected, dp_selected, filters_selected, event_list)
+    lookup = None
+    stats = None
+    if config_filename is not None:
+        config_dict = utilities.read_config(config_filename)
+        lookup = dimension_lookup.DimensionLookup(config_dict)
+        if refresh_ids==True:
+            lookup.refresh()
+        stats = table_stats.TableStats(config_dict)
+        if refresh_stats==True:
+            stats.refresh()
+    query = query_constructor.construct_queries(model_selected, dp_selected, filters_selected, event_list, dimension_lookup=lookup, table_stats=stats)
     write_queries(query, input_filename, output_filename, dp_selected.get_name())
     print("\nYour database queries were written to %s." % output_filename)
 
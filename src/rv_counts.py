@@ -0,0 +1,85 @@
+import sys
+import os
+import sqlite3
+import numpy as np
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+#Value stored for (source, rupture) pairs which aren't in the study
+UNKNOWN_NUM_RVS = -1
+
+#Returns the path to the built-in SQLite DB of rupture variation counts, made by construct_rvs_db.py
+def get_default_db_path():
+    return "%s/num_rvs.sqlite" % (os.path.dirname(os.path.abspath(__file__)))
+
+#In-memory index of the # of rupture variations per rupture, read from the Rupture_Variation_Counts table.
+#Each study is loaded once, into a dense 2-D array indexed by [Source_ID, Rupture_ID].
+class RVCountIndex:
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = get_default_db_path()
+        self.db_path = db_path
+        #Study name -> 2-D array of counts, or None if the study isn't in the DB
+        self.counts = dict()
+
+    def get_db_path(self):
+        return self.db_path
+
+    #Reads the counts for a study from the DB, if we haven't already.  Returns True if the study has counts.
+    def load_study(self, study_name):
+        if study_name in self.counts:
+            return self.counts[study_name] is not None
+        self.counts[study_name] = None
+        if not os.path.exists(self.db_path):
+            return False
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        cur.execute('select Source_ID, Rupture_ID, Num_Rup_Vars from Rupture_Variation_Counts where Study_Name=?', (study_name,))
+        rows = np.array(cur.fetchall(), dtype=np.int64)
+        conn.close()
+        if len(rows)==0:
+            return False
+        (source_ids, rupture_ids, num_rvs) = rows.T
+        counts = np.full((source_ids.max()+1, rupture_ids.max()+1), UNKNOWN_NUM_RVS, dtype=np.int32)
+        counts[source_ids, rupture_ids] = num_rvs
+        self.counts[study_name] = counts
+        return True
+
+    def has_study(self, study_name):
+        return self.load_study(study_name)
+
+    #Returns the # of rupture variations for a single rupture, or UNKNOWN_NUM_RVS
+    def num_rvs(self, study_name, source_id, rupture_id):
+        if not self.load_study(study_name):
+            return UNKNOWN_NUM_RVS
+        counts = self.counts[study_name]
+        if source_id<0 or rupture_id<0 or source_id>=counts.shape[0] or rupture_id>=counts.shape[1]:
+            return UNKNOWN_NUM_RVS
+        return int(counts[source_id, rupture_id])
+
+    #Returns an array of the # of rupture variations for each (source_ids[i], rupture_ids[i]),
+    #with UNKNOWN_NUM_RVS for ruptures which aren't in the study
+    def num_rvs_bulk(self, study_name, source_ids, rupture_ids):
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        rupture_ids = np.asarray(rupture_ids, dtype=np.int64)
+        result = np.full(source_ids.shape, UNKNOWN_NUM_RVS, dtype=np.int32)
+        if not self.load_study(study_name):
+            return result
+        counts = self.counts[study_name]
+        in_range = (source_ids>=0) & (rupture_ids>=0) & (source_ids<counts.shape[0]) & (rupture_ids<counts.shape[1])
+        result[in_range] = counts[source_ids[in_range], rupture_ids[in_range]]
+        return result
+
+
+#Shared index, so each study is only read once per process
+rv_count_index = None
+
+def get_rv_count_index():
+    global rv_count_index
+    if rv_count_index is None:
+        rv_count_index = RVCountIndex()
+    return rv_count_index
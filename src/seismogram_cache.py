@@ -0,0 +1,191 @@
+import sys
+import os
+import json
+import shutil
+import hashlib
+import threading
+import urllib.parse
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+
+#Maximum total size of cached rupture files, in MB.  This is disk used on top of the data collector's temp budget.
+MAX_CACHE_SIZE_MB = 20000
+CACHE_SUFFIX = ".grm"
+#Each entry's rupture variation index, kept by the collector
+INDEX_SUFFIX = ".rvidx"
+STATS_FILENAME = "stats.json"
+#Held while pruning or updating the stats
+CACHE_LOCK_FILENAME = "cache.lock"
+LOCK_SUFFIX = ".lock"
+#Times fetch_copy() refetches an entry which was evicted before it could be linked
+FETCH_COPY_RETRIES = 3
+
+def get_default_cache_dir():
+    return os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'seismograms'))
+
+#Returns the hash identifying the rupture file at url.
+#Files are keyed by study, site, run, source and rupture, so the same file fetched through a different URL shares an entry.
+def get_cache_key(url):
+    parsed = urllib.parse.urlsplit(url)
+    path_pieces = parsed.path.strip("/").split("/")
+    (site_name, run_id, basename) = path_pieces[-3:]
+    filename_pieces = basename.split(".")[0].split("_")
+    key_dict = dict()
+    study_name = utilities.get_study_from_url(url)
+    if study_name is not None:
+        key_dict['study'] = study_name
+    else:
+        key_dict['host'] = "%s://%s" % (parsed.scheme, parsed.netloc)
+    key_dict['site'] = site_name
+    key_dict['run'] = run_id
+    key_dict['source'] = int(filename_pieces[2])
+    key_dict['rupture'] = int(filename_pieces[3])
+    #Keeps broadband and low-frequency files apart
+    key_dict['basename'] = basename
+    key_string = json.dumps(key_dict, sort_keys=True)
+    return hashlib.sha256(key_string.encode('utf-8')).hexdigest()
+
+
+#On-disk cache of whole rupture files, shared between runs, with least-recently-used eviction once it's larger than max_size_mb.
+#Entries are only ever moved into place complete, and each entry has a lock while it's being downloaded,
+#so concurrent runs wanting the same file download it once.
+class SeismogramCache:
+
+    def __init__(self, cache_dir=None, max_size_mb=MAX_CACHE_SIZE_MB):
+        if cache_dir is None:
+            cache_dir = get_default_cache_dir()
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        #Downloads run on several threads
+        self.count_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, "%s%s" % (key, CACHE_SUFFIX))
+
+    def get_index_path(self, path):
+        return "%s%s" % (path[:-len(CACHE_SUFFIX)], INDEX_SUFFIX)
+
+    def get_index_path_for_url(self, url):
+        return self.get_index_path(self.get_entry_path(get_cache_key(url)))
+
+    #Marks an entry as recently used.  Returns False if it isn't there.
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+        return True
+
+    def count(self, hit):
+        with self.count_lock:
+            if hit==True:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    #Returns the path of the cached copy of url, or None if it isn't cached
+    def get(self, url):
+        path = self.get_entry_path(get_cache_key(url))
+        if self.touch(path):
+            self.count(hit=True)
+            return path
+        self.count(hit=False)
+        return None
+
+    #Returns (path of the cached copy of url, bytes downloaded).  On a miss, download(url, path) fetches it into the cache first.
+    def fetch(self, url, download):
+        path = self.get_entry_path(get_cache_key(url))
+        if not self.touch(path):
+            with utilities.FileLock("%s%s" % (path, LOCK_SUFFIX)):
+                #Another run may have downloaded it while we waited for the lock
+                if not self.touch(path):
+                    #download() writes to a temporary name and renames, so the entry appears complete
+                    num_bytes = download(url, path)
+                    self.count(hit=False)
+                    return (path, num_bytes)
+        self.count(hit=True)
+        return (path, 0)
+
+    #Fetches url like fetch(), then hard-links the cached copy to local_filename, or copies it if it can't be linked.
+    #The caller's file stays readable whatever other runs evict.  Returns bytes downloaded.
+    def fetch_copy(self, url, download, local_filename):
+        num_bytes = 0
+        temp_filename = utilities.get_part_filename(local_filename)
+        for attempt in range(FETCH_COPY_RETRIES):
+            (path, entry_bytes) = self.fetch(url, download)
+            num_bytes += entry_bytes
+            try:
+                try:
+                    os.link(path, temp_filename)
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    #Different filesystem, or no hard links
+                    shutil.copyfile(path, temp_filename)
+            except FileNotFoundError:
+                #Evicted by another run between fetch() and here, unless it's local_filename's directory that's missing
+                if not os.path.isdir(os.path.dirname(os.path.abspath(local_filename))):
+                    raise
+                continue
+            os.replace(temp_filename, local_filename)
+            return num_bytes
+        raise FileNotFoundError("Cached copy of %s was evicted %d times before it could be copied." % (url, FETCH_COPY_RETRIES))
+
+    #Evicts the least recently used entries, and their indexes
+    def prune(self):
+        with utilities.FileLock(os.path.join(self.cache_dir, CACHE_LOCK_FILENAME)):
+            self.prune_locked()
+
+    def prune_locked(self):
+        utilities.prune_lru(self.cache_dir, self.max_size_mb*1000000, suffix=CACHE_SUFFIX)
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(INDEX_SUFFIX) and not os.path.exists(os.path.join(self.cache_dir, "%s%s" % (name[:-len(INDEX_SUFFIX)], CACHE_SUFFIX))):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    #Prunes, and adds this run's hits and misses to the stats
+    def finish(self):
+        with utilities.FileLock(os.path.join(self.cache_dir, CACHE_LOCK_FILENAME)):
+            self.prune_locked()
+            stats = self.get_stats()
+            stats['hits'] += self.hits
+            stats['misses'] += self.misses
+            try:
+                with open(os.path.join(self.cache_dir, STATS_FILENAME), 'w') as fp_out:
+                    json.dump(stats, fp_out)
+            except OSError:
+                pass
+        print("Seismogram cache: %d hits, %d misses (%.0f%% hit rate); %d hits, %d misses overall." % (self.hits, self.misses, 100.0*self.get_hit_rate(self.hits, self.misses), stats['hits'], stats['misses']))
+
+    def get_hit_rate(self, hits, misses):
+        if hits+misses==0:
+            return 0.0
+        return hits/float(hits+misses)
+
+    def get_stats(self):
+        stats = dict()
+        stats['hits'] = 0
+        stats['misses'] = 0
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILENAME), 'r') as fp_in:
+                stats.update(json.load(fp_in))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def get_size_mb(self):
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                total_bytes += os.path.getsize(os.path.join(self.cache_dir, name))
+        return total_bytes/1000000.0
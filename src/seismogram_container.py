@@ -0,0 +1,217 @@
+import sys
+import os
+import argparse
+import threading
+
+import numpy as np
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+
+#Layout of the header before each rupture variation's data
+SEISMOGRAM_HEADER_DTYPE = np.dtype([('version', 'S8'), ('site_name', 'S8'), ('padding', 'S8'),
+                                    ('source_id', '<i4'), ('rupture_id', '<i4'), ('rup_var_id', '<i4'),
+                                    ('dt', '<f4'), ('nt', '<i4'), ('comps', '<i4'),
+                                    ('det_max_freq', '<f4'), ('stoch_max_freq', '<f4')])
+#Container index entries: each record's header, and where its data starts in the data file, in floats
+INDEX_DTYPE = np.dtype(SEISMOGRAM_HEADER_DTYPE.descr + [('offset', '<i8')])
+DATA_SUFFIX = ".seis"
+INDEX_SUFFIX = ".seisidx"
+#Held by the writer for as long as it has the container open
+LOCK_SUFFIX = ".lock"
+NUM_COMPONENTS = 2
+
+def get_container_base(directory, site_name, run_id):
+    return os.path.join(directory, "Seismograms_%s_%s" % (site_name, run_id))
+
+def get_grm_filename(directory, site_name, run_id, source_id, rupture_id, rv):
+    return os.path.join(directory, f"Seismogram_{site_name}_{run_id}_{source_id}_{rupture_id}_{rv}.grm")
+
+#Returns the container index at base, or an empty one
+def load_index(base):
+    try:
+        with open("%s%s" % (base, INDEX_SUFFIX), 'rb') as fp_in:
+            index = np.load(fp_in, allow_pickle=False)
+    except OSError:
+        return np.empty(0, dtype=INDEX_DTYPE)
+    if index.dtype!=INDEX_DTYPE:
+        print("%s%s isn't a seismogram container index, aborting." % (base, INDEX_SUFFIX), file=sys.stderr)
+        sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
+    return index
+
+
+#Appends rupture variation records to one container per site and run: a data file of the records' float32 data back to back,
+#and an index of their headers and offsets.  The index is written by flush() and close(), and anything in the data file
+#past the last indexed record is dropped when a container is reopened, so a run which dies doesn't leave a broken container.
+#Each open container is locked, so another process writing the same one waits for this writer to close.
+#Records already in a container are skipped.  add_record() can be called from several threads.
+class ContainerWriter:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.containers = dict()
+        self.lock = threading.Lock()
+
+    def open_container(self, site_name, run_id):
+        base = get_container_base(self.directory, site_name, run_id)
+        container = dict()
+        container['base'] = base
+        container['lock'] = utilities.FileLock("%s%s" % (base, LOCK_SUFFIX))
+        container['lock'].__enter__()
+        container['entries'] = [load_index(base)]
+        end = 0
+        if len(container['entries'][0])>0:
+            last = container['entries'][0][-1]
+            end = int(last['offset'])+NUM_COMPONENTS*int(last['nt'])
+        container['fp_out'] = open("%s%s" % (base, DATA_SUFFIX), 'ab')
+        container['fp_out'].truncate(end*4)
+        container['end'] = end
+        container['keys'] = set(zip(container['entries'][0]['source_id'].tolist(), container['entries'][0]['rupture_id'].tolist(), container['entries'][0]['rup_var_id'].tolist()))
+        self.containers[(site_name, run_id)] = container
+        return container
+
+    #header is the record's 56-byte header, and data its float32 samples.  Returns False if the container already had it.
+    def add_record(self, site_name, run_id, header, data):
+        header_entry = np.frombuffer(header, dtype=SEISMOGRAM_HEADER_DTYPE, count=1)[0]
+        key = (int(header_entry['source_id']), int(header_entry['rupture_id']), int(header_entry['rup_var_id']))
+        with self.lock:
+            container = self.containers.get((site_name, run_id))
+            if container is None:
+                container = self.open_container(site_name, run_id)
+            if key in container['keys']:
+                return False
+            entry = np.zeros(1, dtype=INDEX_DTYPE)
+            for name in SEISMOGRAM_HEADER_DTYPE.names:
+                entry[name] = header_entry[name]
+            entry['offset'] = container['end']
+            container['fp_out'].write(data)
+            container['end'] += len(data)//4
+            container['entries'].append(entry)
+            container['keys'].add(key)
+        return True
+
+    #Writes the index of the records added so far, after the data it points to
+    def write_index(self, container):
+        container['fp_out'].flush()
+        index = np.concatenate(container['entries'])
+        container['entries'] = [index]
+        temp_filename = utilities.get_part_filename("%s%s" % (container['base'], INDEX_SUFFIX))
+        with open(temp_filename, 'wb') as fp_out:
+            np.save(fp_out, index, allow_pickle=False)
+        os.replace(temp_filename, "%s%s" % (container['base'], INDEX_SUFFIX))
+        return index
+
+    #Makes the records added so far permanent, so they survive the run failing later
+    def flush(self):
+        with self.lock:
+            for container in self.containers.values():
+                self.write_index(container)
+
+    def close(self):
+        with self.lock:
+            for container in self.containers.values():
+                index = self.write_index(container)
+                container['fp_out'].close()
+                container['lock'].__exit__(None, None, None)
+                print("Wrote %d rupture variations to %s%s." % (len(index), container['base'], DATA_SUFFIX))
+            self.containers = dict()
+
+
+#Read access to a container.  The data is memory-mapped, so get_seismogram() returns views without reading the whole file.
+class Container:
+
+    def __init__(self, base):
+        self.base = base
+        self.index = load_index(base)
+        data_filename = "%s%s" % (base, DATA_SUFFIX)
+        if len(self.index)==0 or os.path.getsize(data_filename)==0:
+            self.data = np.empty(0, dtype=np.float32)
+        else:
+            self.data = np.memmap(data_filename, dtype='<f4', mode='r')
+        self.positions = dict()
+        for (i, entry) in enumerate(self.index):
+            self.positions.setdefault((int(entry['source_id']), int(entry['rupture_id']), int(entry['rup_var_id'])), i)
+
+    def get_keys(self):
+        return sorted(self.positions.keys())
+
+    #Returns (header entry, samples as an array of shape (components, nt)), or None if the container doesn't have it
+    def get_seismogram(self, source_id, rupture_id, rv):
+        position = self.positions.get((source_id, rupture_id, rv))
+        if position is None:
+            return None
+        entry = self.index[position]
+        offset = int(entry['offset'])
+        nt = int(entry['nt'])
+        return (entry, self.data[offset:offset+NUM_COMPONENTS*nt].reshape(NUM_COMPONENTS, nt))
+
+    #Writes one rupture variation as a .grm file, byte for byte what the collector would have written.  Returns the filename, or None.
+    def export_grm(self, source_id, rupture_id, rv, output_directory, site_name, run_id):
+        seismogram = self.get_seismogram(source_id, rupture_id, rv)
+        if seismogram is None:
+            return None
+        (entry, samples) = seismogram
+        header = np.zeros(1, dtype=SEISMOGRAM_HEADER_DTYPE)
+        for name in SEISMOGRAM_HEADER_DTYPE.names:
+            header[name] = entry[name]
+        filename = get_grm_filename(output_directory, site_name, run_id, source_id, rupture_id, rv)
+        with open(filename, 'wb') as fp_out:
+            fp_out.write(header.tobytes())
+            fp_out.write(np.ascontiguousarray(samples, dtype='<f4').tobytes())
+        return filename
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='Seismogram Container',
+        description='Exports rupture variation seismograms from a container written by the data collector as .grm files.'
+    )
+    parser.add_argument('-c', '--container', dest='container', action='store', default=None,
+                        help="Path to the container, without the %s or %s extension." % (DATA_SUFFIX, INDEX_SUFFIX))
+    parser.add_argument('-o', '--output-directory', dest='output_directory', action='store', default=".",
+                        help="Directory to write the .grm files to.")
+    parser.add_argument('-s', '--source-id', dest='source_id', action='store', type=int, default=None,
+                        help="Only export this source.")
+    parser.add_argument('-r', '--rupture-id', dest='rupture_id', action='store', type=int, default=None,
+                        help="Only export this rupture.")
+    parser.add_argument('-v', '--rup-var-id', dest='rup_var_id', action='store', type=int, default=None,
+                        help="Only export this rupture variation.")
+    args = parser.parse_args(args=argv)
+    if args.container is None:
+        print("Path to the container must be provided, aborting.", file=sys.stderr)
+        sys.exit(utilities.ExitCodes.MISSING_ARGUMENTS)
+    if not os.path.exists("%s%s" % (args.container, INDEX_SUFFIX)):
+        print("Container %s not found, aborting." % args.container, file=sys.stderr)
+        sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
+    args_dict = dict()
+    args_dict['container'] = args.container
+    args_dict['output_directory'] = args.output_directory
+    args_dict['source_id'] = args.source_id
+    args_dict['rupture_id'] = args.rupture_id
+    args_dict['rup_var_id'] = args.rup_var_id
+    return args_dict
+
+def run_main(argv):
+    args_dict = parse_args(argv)
+    (site_name, run_id) = os.path.basename(args_dict['container']).split("_", 1)[1].rsplit("_", 1)
+    container = Container(args_dict['container'])
+    os.makedirs(args_dict['output_directory'], exist_ok=True)
+    num_exported = 0
+    for (source_id, rupture_id, rv) in container.get_keys():
+        if args_dict['source_id'] is not None and source_id!=args_dict['source_id']:
+            continue
+        if args_dict['rupture_id'] is not None and rupture_id!=args_dict['rupture_id']:
+            continue
+        if args_dict['rup_var_id'] is not None and rv!=args_dict['rup_var_id']:
+            continue
+        container.export_grm(source_id, rupture_id, rv, args_dict['output_directory'], site_name, run_id)
+        num_exported += 1
+    print("Exported %d rupture variations to %s." % (num_exported, args_dict['output_directory']))
+
+if __name__ == "__main__":
+    run_main(sys.argv[1:])
+    sys.exit(0)
@@ -0,0 +1,144 @@
+import sys
+import os
+import json
+import tempfile
+
+#Add one directory level above to path to find imports
+full_path = os.path.abspath(sys.argv[0])
+path_add = os.path.dirname(os.path.dirname(full_path))
+sys.path.append(path_add)
+
+import utilities
+import query_cache
+import db_connection
+import join_planner
+
+#Tables we keep row counts for
+stats_tables = sorted([t for t in join_planner.table_costs if t!=utilities.EVENT_TABLE_NAME])
+#Columns whose number of distinct values is the size of a lookup table, which is cheap to count
+key_columns = dict()
+key_columns["Studies.Study_Name"] = "Studies"
+key_columns["CyberShake_Runs.Study_ID"] = "Studies"
+key_columns["CyberShake_Sites.CS_Short_Name"] = "CyberShake_Sites"
+key_columns["CyberShake_Runs.Site_ID"] = "CyberShake_Sites"
+key_columns["IM_Types.IM_Type_Value"] = "IM_Types"
+key_columns["PeakAmplitudes.IM_Type_ID"] = "IM_Types"
+#Keys which are shared by all the tables with a column of the same name, and which can be counted on the small CyberShake_Runs table
+run_key_columns = ["ERF_ID", "Rup_Var_Scenario_ID"]
+#Numeric columns to find the range of, for estimating range filters.  Only columns on tables small enough to scan.
+range_columns = ["Ruptures.Mag", "CyberShake_Site_Ruptures.Site_Rupture_Dist"]
+
+def get_default_cache_dir():
+    return os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'table_stats'))
+
+
+#Table sizes, column ranges and (on MySQL) index definitions, gathered from the database once and saved locally,
+#one file per database.  Used by join_planner.order_joins() to estimate how selective each filter is.
+class TableStats:
+
+    def __init__(self, config_dict, cache_dir=None):
+        self.config_dict = config_dict
+        if cache_dir is None:
+            cache_dir = get_default_cache_dir()
+        self.cache_dir = cache_dir
+        self.cache_path = os.path.join(self.cache_dir, "%s.json" % query_cache.get_database_key(config_dict))
+        self.stats = None
+        #Counts refreshes, so queries built from earlier contents can be told apart
+        self.generation = 0
+
+    #Gathers the statistics from the database, and saves them.
+    #If the database can't be read, warns and uses no statistics, so join_planner falls back to its default estimates.
+    def refresh(self):
+        self.generation += 1
+        stats = dict()
+        stats['row_counts'] = dict()
+        stats['ranges'] = dict()
+        stats['indexes'] = dict()
+        stats['distinct_counts'] = dict()
+        try:
+            conn = db_connection.connect(self.config_dict)
+        except Exception as e:
+            print("Warning: couldn't connect to the database to gather table statistics, so the join order will be estimated without them: %s" % str(e), file=sys.stderr)
+            self.stats = stats
+            return
+        cur = db_connection.get_cursor(conn, self.config_dict)
+        mysql = (self.config_dict['type'].lower()=='mysql')
+        try:
+            if mysql:
+                #InnoDB's estimates are good enough, and counting PeakAmplitudes isn't an option
+                cur.execute('select TABLE_NAME, TABLE_ROWS from information_schema.TABLES where TABLE_SCHEMA=%s', (self.config_dict['db'],))
+                for row in cur.fetchall():
+                    if row['TABLE_NAME'] in stats_tables:
+                        stats['row_counts'][row['TABLE_NAME']] = int(row['TABLE_ROWS'] or 0)
+            else:
+                for t in stats_tables:
+                    cur.execute('select count(*) as Num_Rows from %s' % t)
+                    stats['row_counts'][t] = int(cur.fetchone()['Num_Rows'])
+            for c in run_key_columns:
+                cur.execute('select count(distinct %s) as Num_Values from CyberShake_Runs' % c)
+                stats['distinct_counts'][c] = int(cur.fetchone()['Num_Values'])
+            for c in range_columns:
+                cur.execute('select min(%s) as Min_Value, max(%s) as Max_Value from %s' % (c, c, c.split(".")[0]))
+                row = cur.fetchone()
+                if row['Min_Value'] is not None:
+                    stats['ranges'][c] = [float(row['Min_Value']), float(row['Max_Value'])]
+            if mysql:
+                #Index name -> leading column, for index hints
+                for t in stats_tables:
+                    cur.execute('SHOW INDEX FROM %s' % t)
+                    for row in cur.fetchall():
+                        if int(row['Seq_in_index'])==1:
+                            stats['indexes'].setdefault(t, dict())[row['Key_name']] = row['Column_name']
+        except Exception as e:
+            print("Warning: couldn't gather table statistics from the database, so the join order will be estimated without them: %s" % str(e), file=sys.stderr)
+            cur.close()
+            conn.close()
+            self.stats = dict([(k, dict()) for k in stats])
+            return
+        cur.close()
+        conn.close()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            (fd, temp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, 'w') as fp_out:
+                json.dump(stats, fp_out)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print("Warning: couldn't save table statistics to %s: %s" % (self.cache_path, str(e)))
+        self.stats = stats
+
+    def load(self):
+        if self.stats is not None:
+            return
+        try:
+            with open(self.cache_path, 'r') as fp_in:
+                self.stats = json.load(fp_in)
+        except (OSError, ValueError):
+            self.refresh()
+
+    #Returns the number of rows in the table, or None if unknown
+    def get_row_count(self, table):
+        self.load()
+        return self.stats['row_counts'].get(table)
+
+    #Returns the number of distinct values in a column, or None if unknown
+    def get_distinct_count(self, column):
+        if column in key_columns:
+            return self.get_row_count(key_columns[column])
+        self.load()
+        return self.stats.get('distinct_counts', dict()).get(column.split(".")[1])
+
+    #Returns (min, max) for a numeric column, or None if unknown
+    def get_range(self, column):
+        self.load()
+        if column not in self.stats['ranges']:
+            return None
+        return tuple(self.stats['ranges'][column])
+
+    #Returns the name of an index on table whose leading column is column, or None
+    def get_index(self, table, column):
+        self.load()
+        for (name, leading_column) in sorted(self.stats['indexes'].get(table, dict()).items()):
+            if leading_column==column:
+                return name
+        return None
@@ -246,9 +246,6 @@ def get_user_input(model_list, dp_list, filter_list, input_event_filename=None):
         except Exception as e:
             print("Error reading file %s: %s" % (input_event_filename, e), file=sys.stderr)
             sys.exit(utilities.ExitCodes.BAD_FILE_PATH)
-        if len(event_list) > utilities.MAX_EVENT_LIST_LENGTH:
-            print("Too many events in file: %d" % len(event_list), file=sys.stderr)
-            sys.exit(utilities.ExitCodes.FILE_PARSING_ERROR)
         filter_list = [f for f in filter_list if f.get_data_product() != filters.FilterDataProducts.EVENTS]
 
     selected_filters = choose_filters(filter_list, selected_dp, selected_model)
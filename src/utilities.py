@@ -3,11 +3,36 @@
 import sys
 import os
 import json
+import time
+import threading
 
 VERSION = "1.0.0_09052023"
 
-#Maximum of 120K events in the event list, because otherwise the MySQL query might be too long
-MAX_EVENT_LIST_LENGTH = 120000
+#Event lists with at least this many events are loaded into a temporary table and joined, instead of written into the query
+EVENT_TABLE_MIN_EVENTS = 1000
+#Name of the temporary table holding the event list
+EVENT_TABLE_NAME = "Event_List"
+
+#Where each study's seismograms are downloaded from
+globus_dict = dict()
+globus_dict['Study 15.12'] = "https://g-41ed52.a78b8.36fe.data.globus.org"
+globus_dict['Study 22.12 LF'] = "https://g-be1d0b.a78b8.36fe.data.globus.org"
+globus_dict['Study 22.12 BB'] = "https://g-2d87a9.a78b8.36fe.data.globus.org"
+
+#Seismogram filename suffixes for broadband studies
+suffix_dict = dict()
+suffix_dict['Study 15.12'] = "_bb"
+suffix_dict['Study 22.12 BB'] = "_bb"
+
+#Size of the header before each rupture variation's data in a seismogram file
+SEISMOGRAM_HEADER_SIZE = 56
+
+#Seconds between attempts to take a FileLock
+LOCK_POLL_INTERVAL = 0.1
+#Seconds between refreshes of a held FileLock's modification time
+LOCK_HEARTBEAT_SECONDS = 60
+#FileLocks not refreshed for this long were left by a run which died, and are broken
+STALE_LOCK_SECONDS = 600
 
 class ExitCodes:
 
@@ -24,6 +49,7 @@ class ExitCodes:
 	DATABASE_COMMAND_ERROR = 10
 	FILE_WRITING_ERROR = 11
 	FILE_DOWNLOAD_ERROR = 12
+	QUERY_CONSTRUCTION_ERROR = 13
 
 
 class CSJSONEncoder(json.JSONEncoder):
@@ -67,7 +93,7 @@ def get_field_alias(field):
 def get_rv_seismogram_size(study_name):
 	components = 2
 	sizeof_float = 4
-	header_size = 56
+	header_size = SEISMOGRAM_HEADER_SIZE
 	if study_name=='Study 15.12':
 		nt = 12000
 	elif study_name=='Study 22.12 LF':
@@ -76,6 +102,92 @@ def get_rv_seismogram_size(study_name):
 		nt = 40000
 	return components*nt*sizeof_float + header_size
 
+#Returns the study whose seismograms are at url, or None if it isn't from a known endpoint
+def get_study_from_url(url):
+	for (study_name, prefix) in globus_dict.items():
+		if url.startswith("%s/" % prefix):
+			return study_name
+	return None
+
+#Deletes the least recently used files in directory with the given suffix until their total size is at most max_bytes
+#Files are ordered by modification time, so readers should os.utime() a file when they use it
+def prune_lru(directory, max_bytes, suffix=""):
+	entries = []
+	total_bytes = 0
+	for name in os.listdir(directory):
+		if not name.endswith(suffix):
+			continue
+		path = os.path.join(directory, name)
+		try:
+			stat_result = os.stat(path)
+		except OSError:
+			continue
+		entries.append((stat_result.st_mtime, stat_result.st_size, path))
+		total_bytes += stat_result.st_size
+	entries.sort()
+	num_removed = 0
+	for (mtime, size, path) in entries:
+		if total_bytes<=max_bytes:
+			break
+		try:
+			os.remove(path)
+		except OSError:
+			continue
+		total_bytes -= size
+		num_removed += 1
+	return num_removed
+
+#Returns a name to write filename's contents to before renaming it into place, unique to this process and thread
+def get_part_filename(filename):
+	return "%s.%d.%d.part" % (filename, os.getpid(), threading.get_ident())
+
+#Lock file created with O_EXCL, so that it works across processes, and on network filesystems.
+#While it's held, a thread refreshes its modification time, so only locks left by a run which died go stale.
+class FileLock:
+
+	def __init__(self, path):
+		self.path = path
+		self.stop_event = None
+		self.heartbeat_thread = None
+
+	def __enter__(self):
+		while True:
+			try:
+				fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+			except FileExistsError:
+				try:
+					if time.time()-os.path.getmtime(self.path)>STALE_LOCK_SECONDS:
+						os.remove(self.path)
+						continue
+				except OSError:
+					#Released while we were looking at it
+					continue
+				time.sleep(LOCK_POLL_INTERVAL)
+				continue
+			with os.fdopen(fd, 'w') as fp_out:
+				fp_out.write("%d\n" % os.getpid())
+			break
+		self.stop_event = threading.Event()
+		self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+		self.heartbeat_thread.start()
+		return self
+
+	def heartbeat(self):
+		while not self.stop_event.wait(LOCK_HEARTBEAT_SECONDS):
+			try:
+				os.utime(self.path)
+			except OSError:
+				pass
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop_event.set()
+		self.heartbeat_thread.join()
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+		return False
+
 def read_config(config_file):
     config_dict = dict()
     with open(config_file, "r") as fp_in: